@@ -2,6 +2,9 @@ import gettext
 gettext.install('elshelves', unicode=1)
 
 import os
+import sys
+import time
+import datetime
 import optparse
 
 import urwid
@@ -9,6 +12,8 @@ import urwid.web_display
 from version import __version__
 import model
 import app
+import indexer
+import executor
 from main import Actions
 from part_selector import SearchForParts, PartCreator
 
@@ -19,8 +24,29 @@ def main():
 
     parser = optparse.OptionParser()
     parser.add_option("--importorg", action="store", default = None)
+    parser.add_option("--reindex", action="store_true", default = False,
+                      help = "rebuild the search indexes and exit")
+    parser.add_option("--since", action="store", default = None,
+                      help = "reindex only part types changed since the given UTC time (YYYY-mm-dd[ HH:MM:SS])")
+    parser.add_option("--verify-counters", action="store_true", default = False,
+                      help = "compare the stock counters with parts and exit")
+    parser.add_option("--repair-counters", action="store_true", default = False,
+                      help = "recompute the stock counters which differ from parts and exit")
+    parser.add_option("--archive-history", action="store", type="int", default = None, metavar = "DAYS",
+                      help = "move history events older than DAYS days to the archive and exit")
     opts, args = parser.parse_args()
 
+    since = None
+    if opts.since:
+        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                since = datetime.datetime.strptime(opts.since, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            parser.error("invalid --since timestamp: %s" % opts.since)
+
     # let me use different database file
     if args:
         dbfile = args[0]
@@ -34,8 +60,35 @@ def main():
     errlog = file(os.path.join(confdir, "error_log"), "w")
     model.debug(errlog)
 
-    store = model.getStore("sqlitefk:%s" % dbfile,
-                           create = not os.path.exists(dbfile))
+    url = "sqlitefk:%s" % dbfile
+    store = model.getStore(url, create = not os.path.exists(dbfile))
+
+    if opts.reindex:
+        start = time.time()
+        count = indexer.reindex(store, since = since)
+        elapsed = max(time.time() - start, 1e-6)
+        print "Reindexed %d part types in %.2f s (%.0f part types/s)" % (count, elapsed, count / elapsed)
+        sys.exit(0)
+
+    if opts.verify_counters or opts.repair_counters:
+        differences = model.StockCounter.verify(store, repair = opts.repair_counters)
+        for type_id, stored, computed in differences:
+            print "part type %d: stored %s, computed %s" % (type_id,
+                ", ".join("%s %d" % c for c in zip(model.StockCounter.COLUMNS, stored)),
+                ", ".join("%s %d" % c for c in zip(model.StockCounter.COLUMNS, computed)))
+
+        if not differences:
+            print "Stock counters are correct"
+        elif opts.repair_counters:
+            print "Repaired counters of %d part types" % len(differences)
+
+        sys.exit(1 if differences and not opts.repair_counters else 0)
+
+    if opts.archive_history is not None:
+        before = datetime.datetime.utcnow().replace(microsecond = 0) - datetime.timedelta(days = opts.archive_history)
+        count = model.History.archive(store, before)
+        print "Archived %d history events older than %s" % (count, before)
+        sys.exit(0)
 
     schema_version = store.get(model.Meta, u"version").value
 
@@ -76,7 +129,15 @@ def main():
         except:
             raise
 
-    a.run()
+    background_indexer = indexer.BackgroundIndexer(url)
+    background_indexer.start()
+    a.executor = executor.QueryExecutor(url)
+    a.executor.start()
+    try:
+        a.run()
+    finally:
+        a.executor.stop()
+        background_indexer.stop()
 
 if '__main__' == __name__ or urwid.web_display.is_web_request():
     main()
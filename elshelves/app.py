@@ -2,6 +2,7 @@ import urwid
 import urwid.raw_display
 import urwid.web_display
 import weakref
+import functools
 import re
 import edit
 from dialog import Dialog
@@ -12,24 +13,31 @@ class PopUpEnabledFrame(urwid.PopUpLauncher):
         self.__super.__init__(original_widget)
         self._dialogs = []
         self._dialog_sizes = []
+        self._dialog_callbacks = []
 
-    def show_dialog(self, dialog_instance, sizes):
+    def show_dialog(self, dialog_instance, sizes, cb = None):
+        """Opens the dialog over the current dialog or screen,
+        cb is returned by hide_dialog when the dialog gets closed."""
         self._dialogs.append(dialog_instance)
         self._dialog_sizes.append(sizes)
+        self._dialog_callbacks.append(cb)
         self.open_pop_up()
 
     def hide_dialog(self, dialog_instance):
         closed_dialog = self._dialogs.pop()
         assert closed_dialog == dialog_instance
         self._dialog_sizes.pop()
+        cb = self._dialog_callbacks.pop()
         if self._dialogs == []:
             self.close_pop_up()
         else:
             self.open_pop_up()
+        return cb
 
     @property
     def current_dialog(self):
-        return self._dialogs[-1]
+        if self._dialogs:
+            return self._dialogs[-1]
 
     def set_body(self, w):
         return self._original_widget.set_body(w)
@@ -82,6 +90,9 @@ class App(object):
         ]
 
     screen = None
+    loop = None
+    # QueryExecutor running the queries of screens in background
+    executor = None
 
     def __init__(self, title):
         self._title = title
@@ -95,48 +106,54 @@ class App(object):
         # screen stack contains triplets
         #  UIScreen to show
         #  arguments for it's show method
-        #  value indicating whether new mainloop is needed - None = do nothing, True = execute, False = already running, exit when window closes
+        #  callback to call after the screen gets closed or None
         self._screens = []
 
     def switch_screen(self, ui, args = None):
-        oldscr, oldattr, oldloop = self._screens.pop()
-        self._screens.append((ui, args, oldloop))
+        oldscr, oldattr, oldcb = self._screens.pop()
+        self._screens.append((ui, args, oldcb))
         self.redraw()
 
     def switch_screen_with_return(self, ui, args = None):
         self._screens.append((ui, args, None))
         self.redraw()
 
-    def switch_screen_modal(self, ui, args = None):
-        self._screens.append((ui, args, True))
+    def switch_screen_modal(self, ui, args = None, cb = None, *cb_args, **cb_kwargs):
+        """Shows the screen and calls cb(*cb_args, **cb_kwargs) once
+        it gets closed and the previous screen is shown again."""
+        if cb is not None:
+            cb = functools.partial(cb, *cb_args, **cb_kwargs)
+        self._screens.append((ui, args, cb))
         self.redraw()
-        self.redraw() # get back to the previous screen
-
 
     def close_screen(self, scr = None):
-        oldscr, oldattr, oldloop = self._screens.pop()
+        oldscr, oldattr, oldcb = self._screens.pop()
         if scr is not None:
             if oldscr != scr:
                 self.debug()
 
-        # we are in modal window, end it's loop
-        assert oldloop != True # this cannot happen, if we are closing the window, the loop must be running
-        if oldloop == False:
-            raise urwid.ExitMainLoop()
-
         if self._screens:
             self.redraw()
         else:
             raise urwid.ExitMainLoop()
 
-    def run_dialog(self, dialog):
+        if oldcb is not None:
+            oldcb()
+
+    def run_dialog(self, dialog, cb = None, *args, **kwargs):
+        """Opens the dialog and returns immediately, the main loop keeps
+        running. Once the dialog is closed with a positive result,
+        cb(*args, **kwargs) gets called."""
+        if cb is not None:
+            cb = functools.partial(cb, *args, **kwargs)
 
         sizes = dialog.dialog_size()
-        self._frame.show_dialog(dialog, sizes)
+        self._frame.show_dialog(dialog, sizes, cb)
 
-        self.run(self.dialog_input)
-        self._frame.hide_dialog(dialog)
-        return dialog.result
+    def close_dialog(self, dialog):
+        cb = self._frame.hide_dialog(dialog)
+        if cb is not None and dialog.result:
+            cb()
 
     def debug(self):
         if self.screen:
@@ -150,32 +167,48 @@ class App(object):
         if not self._screens:
             return
 
-        screen, args, newloop = self._screens[-1]
-        body = screen.show(args)
+        # the queries of the previous screen are not needed anymore
+        if self.executor:
+            self.executor.cancel()
 
-        title = screen.title or self._title or u""
-        footer = screen.footer or u""
+        screen, args, cb = self._screens[-1]
+        body = screen.show(args)
 
         if body:
             body = urwid.AttrMap(body, {"default": "body",
                                         None: "body",
                                         "": "body"})
             self._frame.set_body(body)
-            self._header.set_text(title)
-            self._footer.set_text(footer)
+            self.update_title(screen)
 
-        if newloop == True:
-            self._screens.pop()
-            self._screens.append((screen, args, False))
-            self.run()
+    @property
+    def current_screen(self):
+        if self._screens:
+            return self._screens[-1][0]
 
-    def run(self, input_handler = None):
-        if input_handler is None:
-            input_handler = self.input
+    def update_title(self, screen):
+        """Shows the current title and footer of screen when it is
+        the screen on top."""
+        if self.current_screen is not screen:
+            return
 
-        urwid.MainLoop(self._frame, self.palette, self.screen,
-                       unhandled_input=input_handler,
-                       pop_ups=True).run()
+        self._header.set_text(screen.title or self._title or u"")
+        self._footer.set_text(screen.footer or u"")
+
+    def run(self):
+        """Runs the main loop, screens and dialogs are switched inside
+        of it until the last screen gets closed."""
+        self.loop = urwid.MainLoop(self._frame, self.palette, self.screen,
+                                   unhandled_input=self.input,
+                                   pop_ups=True)
+        if self.executor:
+            self.executor.attach(self.loop)
+        try:
+            self.loop.run()
+        finally:
+            if self.executor:
+                self.executor.detach(self.loop)
+            self.loop = None
 
     def _setup(self, title):
         urwid.web_display.set_preferences(title)
@@ -204,6 +237,10 @@ class App(object):
     def input(self, key):
         """Method called to process unhandled input key and mouse presses."""
 
+        # modal dialog is open, the screen under it gets no keys
+        if self._frame.current_dialog:
+            return self.dialog_input(key)
+
         if self._screens:
             key = self._screens[-1][0].input(key)
             if key is None:
@@ -231,6 +268,18 @@ class UIScreen(object):
         """Method which is called before the screen is displayed. Is has to return the top level widget containing the contents."""
         pass
 
+    def query(self, function, callback, *args):
+        """Runs function(store, *args) by the query executor of the
+        application and passes its result to callback. Without a running
+        executor the function gets the store of the screen and runs
+        immediately. Returns the submitted job or None."""
+        executor = self.app.executor
+        if executor is None or not executor.attached:
+            callback(function(self.store, *args))
+            return None
+
+        return executor.submit(function, callback, *args)
+
     def back(self, args = None):
         if self._back:
             if args is None:
@@ -260,8 +309,7 @@ class UIScreen(object):
                                 _(self.CONFIRM_CLOSE),
                                 yes = "Close", no = "Keep open")
 
-            if self.app.run_dialog(confirmdlg):
-              return cb(*args, **kwargs)
+            self.app.run_dialog(confirmdlg, cb, *args, **kwargs)
         else:
             return cb(*args, **kwargs)
 
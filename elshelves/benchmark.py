@@ -0,0 +1,151 @@
+# encoding: utf8
+
+"""Benchmark of the part matching used when importing orders.
+
+Creates a temporary database using the generator of synthetic data
+and compares matching the lines of an order one by one with the batched
+matching:
+
+    python -m elshelves.benchmark [--types N] [--lines N]
+"""
+
+import os
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import storm.tracer
+import model
+import generate
+
+class QueryCounter(object):
+    """Storm tracer counting the executed statements"""
+
+    def __init__(self):
+        self.count = 0
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.count += 1
+
+def order(store, lines, types, sources, rnd):
+    """Returns the RawParts of a synthetic order"""
+    parts = []
+    for i in range(lines):
+        type_id = rnd.randint(1, types)
+        part_type = store.get(model.PartType, type_id)
+        parts.append(model.RawPart({
+            "search_name": rnd.choice([part_type.name, part_type.name.lower(),
+                                       part_type.summary.split()[0]]),
+            "manufacturer": part_type.manufacturer,
+            "footprint": part_type.footprint.name,
+            "sku": rnd.choice([u"", part_type.sources.any().sku]),
+            "source": rnd.choice(sources),
+            "count": 1
+            }))
+
+    return parts
+
+def fill_matches_single(store, data):
+    """Reference matching of one order line by separate queries for
+       every criterion, intersected in Python, the way fill_matches
+       worked before the lines got matched in batches"""
+    parts = []
+
+    if data.search_name:
+        parts.append([part_type.id for part_type in model.Term.search(store, data.search_name)])
+
+    if data.sku:
+        args = [model.PartSource.sku.like(u"%s%%" % data.sku, "$", False)]
+        if data.source is not None:
+            args.append(model.PartSource.source == data.source)
+
+        # do not filter by sku if no such vendor/sku was found
+        result = list(store.find(model.PartSource, *args)
+                      .config(distinct = True)
+                      .values(model.PartSource.part_type_id))
+        if result:
+            parts.append(result)
+
+    if data.manufacturer:
+        parts.append(list(store.find(model.PartType,
+                                     model.Or(model.PartType.manufacturer == u"",
+                                              model.PartType.manufacturer.like(u"%%%s%%" % data.manufacturer, "$", False)))
+                          .config(distinct = True)
+                          .values(model.PartType.id)))
+
+    if data.footprint:
+        parts.append(list(store.find((model.PartType, model.Footprint),
+                                     model.Footprint.name.like(u"%%%s%%" % data.footprint, "$", False),
+                                     model.PartType.footprint_id == model.Footprint.id)
+                          .config(distinct = True)
+                          .values(model.PartType.id)))
+
+    res = set(parts[0]) if parts else set()
+    for p in parts[1:]:
+        res.intersection_update(p)
+
+    # nothing found, offer the similar names satisfying the other conditions
+    data.scores = {}
+    if not res and data.search_name:
+        candidates = None
+        if len(parts) > 1:
+            candidates = set(parts[1])
+            for p in parts[2:]:
+                candidates.intersection_update(p)
+
+        data.scores = dict(model.fuzzy_matcher(store).match(data.search_name,
+                                                            candidates = candidates))
+        res = set(data.scores)
+
+    data.matches = res
+    return data
+
+def measure(label, function):
+    counter = QueryCounter()
+    storm.tracer.install_tracer(counter)
+    start = time.time()
+    try:
+        result = function()
+    finally:
+        storm.tracer.remove_tracer(counter)
+
+    print "%-12s %8.3f s %8d queries" % (label, time.time() - start, counter.count)
+    return result
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--types", type="int", default = 5000,
+                      help = "number of part types in the database")
+    parser.add_option("--lines", type="int", default = 400,
+                      help = "number of lines in the matched order")
+    parser.add_option("--seed", type="int", default = 0)
+    opts, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix = "elshelves-benchmark")
+    try:
+        store = model.getStore("sqlitefk:%s" % os.path.join(tmpdir, "benchmark.sqlite3"),
+                               create = True)
+        rnd = random.Random(opts.seed)
+        generate.generate(store, rnd, types = opts.types, piles = 0, projects = 0)
+        sources = list(store.find(model.Source))
+        parts = order(store, opts.lines, opts.types, sources, rnd)
+        store.commit()
+
+        print "%d part types, %d order lines" % (opts.types, opts.lines)
+        single = measure("per line",
+                         lambda: [fill_matches_single(store, model.RawPart(p.__dict__)) for p in parts])
+        batched = measure("batched",
+                          lambda: model.fill_matches_many(store, [model.RawPart(p.__dict__) for p in parts]))
+
+        assert [p.matches for p in single] == [p.matches for p in batched]
+
+        cache = model.Term.SIMPLIFIED
+        print "simplify cache: %d words, %d hits, %d misses" % (len(cache), cache.hits, cache.misses)
+        store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 
 from . import model
 import urwid
+from storm.expr import Sum
 from .app import Edit, IntEdit, Text, FloatEdit, DateEdit, CheckBox
 from .generics import GenericBrowser, GenericEditor
 
@@ -15,18 +16,38 @@ class HistoryBrowser(GenericBrowser):
         (_(u"description"), "weight", 1, "description")
         ]
     SORT = False
+    KEYS = GenericBrowser.KEYS + {
+        "o": (_(u"older"), "older", lambda self: self._older is not None)
+        }
+    # number of archived records loaded at once
+    PAGE = 100
 
     def __init__(self, a, store, history = None):
         GenericBrowser.__init__(self, a, store)
-        self._history = []
-        while history:
-            self._history.append(history)
-            history = history.parent
+        if history:
+            self._history = history.chain()
+        else:
+            self._history = []
+
+        # the chain continues in the archive
+        self._older = None
+        if self._history and self._history[-1].event == model.History.ARCHIVED:
+            self._older = self._history[-1].id
 
     @property
     def content(self, args = None):
         return self._history
 
+    def older(self, widget, id):
+        archived = model.ArchivedHistory.chain(self.store, self._older, self.PAGE)
+        if self._history[-1].event == model.History.ARCHIVED:
+            # the archived original replaces the summary
+            self._history.pop()
+        self._history.extend(archived)
+        self._older = archived[-1].parent_id if archived else None
+        self.focus = id
+        return self.REFRESH
+
     @property
     def title(self):
         return _(u"History")
@@ -122,10 +143,6 @@ class PartEditor(GenericEditor):
         else:
             return False
 
-    def pre_commit_hook(self, item):
-        # update records in search term table
-        model.Term.register(item)
-
 class Browser(GenericBrowser):
     MODEL = model.PartType
     FIELDS = [
@@ -137,6 +154,11 @@ class Browser(GenericBrowser):
         (_(u"total"), "fixed", 6, "count_w_assigned"),
         (_(u"free"), "fixed", 6, "count")
         ]
+    AGGREGATES = {
+        "count_w_assigned": (model.StockCounter.type_id,
+                             Sum(model.StockCounter.free + model.StockCounter.assigned)),
+        "count": (model.StockCounter.type_id, Sum(model.StockCounter.free))
+        }
     EDITOR = PartEditor
 
     def __init__(self, a, store, search = None, footprint = None):
@@ -196,10 +218,6 @@ class RawPartEditor(GenericEditor):
         else:
             return False
 
-    def pre_commit_hook(self, item):
-        # update records in search term table
-        model.Term.register(item.part_type)
-
 class RawPartBrowser(Browser):
     MODEL = model.Part
     EDITOR = RawPartEditor
@@ -214,6 +232,7 @@ class RawPartBrowser(Browser):
         (_(u"asn"), "fixed", 3, "assigned"),
         (_(u"sld"), "fixed", 3, "soldered")
         ]
+    AGGREGATES = {}
 
     def __init__(self, a, store, unusable = False, assigned = True):
         GenericBrowser.__init__(self, a, store)
@@ -277,6 +296,7 @@ class FootprintBrowser(Browser):
         (_(u"holes"), "fixed", 5, "holes"),
         (_(u"pins"), "fixed", 4, "pins")
         ]
+    AGGREGATES = {}
 
     def __init__(self, a, store, part_type = None):
         GenericBrowser.__init__(self, a, store)
@@ -24,7 +24,7 @@ class Dialog(urwid.WidgetWrap):
         pass
 
     def close(self):
-        raise urwid.ExitMainLoop()
+        self.app.close_dialog(self)
 
     def dialog_size(self):
         raise Exception("Mus be implemented in subclass")
@@ -0,0 +1,127 @@
+# encoding: utf8
+
+import os
+import sys
+import Queue
+import threading
+import collections
+import model
+
+class Job(object):
+    """Query submitted to the QueryExecutor"""
+
+    def __init__(self, executor, function, callback, args):
+        self._executor = executor
+        self.function = function
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self._executor.cancel(self)
+
+class QueryExecutor(threading.Thread):
+    """Thread running the queries submitted by screens using its own
+       database connection, so the UI keeps responding while they run.
+
+       A submitted function gets the store of the executor and must
+       return plain values (ids, counts), not the objects loaded by it.
+       The results are passed to the callbacks in the thread of the urwid
+       main loop, woken up through a pipe it watches. Cancelled queries
+       are interrupted and their results dropped."""
+
+    def __init__(self, url):
+        threading.Thread.__init__(self, name = "executor")
+        self.daemon = True
+        self._url = url
+        self._queue = Queue.Queue()
+        self._done = collections.deque()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._running = None
+        self._store = None
+        self._pipe = None
+
+    def attach(self, loop):
+        """Delivers the results to the urwid main loop"""
+        self._pipe = loop.watch_pipe(self._deliver)
+
+    def detach(self, loop):
+        pipe, self._pipe = self._pipe, None
+        self.cancel()
+        loop.remove_watch_pipe(pipe)
+
+    @property
+    def attached(self):
+        return self._pipe is not None
+
+    def submit(self, function, callback, *args):
+        """Queues function(store, *args), its result gets passed
+           to callback. Returns the Job which can be cancelled."""
+        job = Job(self, function, callback, args)
+        with self._lock:
+            self._pending.add(job)
+        self._queue.put(job)
+        return job
+
+    def cancel(self, job = None):
+        """Cancels the job or all the submitted jobs"""
+        with self._lock:
+            jobs = [job] if job else list(self._pending)
+            for j in jobs:
+                j.cancelled = True
+                self._pending.discard(j)
+                if j is self._running:
+                    # the connection belongs to the executor thread,
+                    # but interrupting it is allowed from any thread
+                    self._store._connection._raw_connection.interrupt()
+
+    def run(self):
+        self._store = model.getStore(self._url)
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    break
+
+                with self._lock:
+                    if job.cancelled:
+                        continue
+                    self._running = job
+
+                result = error = None
+                try:
+                    result = job.function(self._store, *job.args)
+                except Exception:
+                    error = sys.exc_info()
+                finally:
+                    with self._lock:
+                        self._running = None
+
+                # end the read transaction, so the next query sees
+                # changes committed by other connections
+                self._store.rollback()
+
+                self._done.append((job, result, error))
+                pipe = self._pipe
+                if pipe is not None:
+                    os.write(pipe, "x")
+        finally:
+            self._store.close()
+
+    def _deliver(self, data):
+        while self._done:
+            job, result, error = self._done.popleft()
+            with self._lock:
+                if job.cancelled:
+                    continue
+                self._pending.discard(job)
+
+            if error:
+                raise error[0], error[1], error[2]
+            job.callback(result)
+
+    def stop(self):
+        self.cancel()
+        self._queue.put(None)
+        self.join()
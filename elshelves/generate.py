@@ -0,0 +1,258 @@
+# encoding: utf8
+
+"""Generator of synthetic warehouse databases.
+
+Creates a new database filled with footprints, part types registered
+for searching, vendors with their prices, piles of parts with long
+histories and projects using them. The same seed and sizes always
+give the same data:
+
+    python -m elshelves.generate [options] DATABASE
+"""
+
+import os
+import time
+import random
+import datetime
+import optparse
+import itertools
+
+import model
+import indexer
+
+WORDS = [u"resistor", u"capacitor", u"ceramic", u"film", u"led", u"red",
+         u"green", u"diode", u"schottky", u"mcu", u"avr", u"regulator",
+         u"odpor", u"kondenzátor", u"keramický", u"zelená", u"červená"]
+MANUFACTURERS = [u"", u"TI", u"Atmel", u"Vishay", u"NXP", u"Yageo"]
+VALUES = [u"1", u"2.2", u"4.7", u"10", u"22", u"47", u"100", u"330"]
+UNITS = [u"R", u"k", u"pF", u"nF", u"uF", u"V", u"mA"]
+
+# two pin packages first, the rest of the footprints is
+# the cartesian product of the families and pin counts
+PASSIVES = [u"0201", u"0402", u"0603", u"0805", u"1206", u"1210", u"2512"]
+FAMILIES = [u"SOT", u"DIP", u"SOIC", u"TSSOP", u"QFN", u"TQFP", u"BGA", u"SIP"]
+
+# piles get changed by these events during their life
+CHANGES = [model.History.MOVED, model.History.UPDATED, model.History.TESTED]
+
+START = datetime.datetime(2010, 1, 1)
+
+def footprint_names():
+    """Yields unique (name, pins) of footprints, the common ones first"""
+    for name in PASSIVES:
+        yield name, 2
+
+    for pins in itertools.count(3):
+        for family in FAMILIES:
+            yield u"%s%d" % (family, pins), pins
+
+def generate(store, rnd, footprints = 1000, types = 20000, sources = 5,
+             piles = 20000, split = 0.2, projects = 20, items = 10,
+             assignments = 20, depth = 10):
+    """Fills the empty database with synthetic data using rnd as the only
+       source of randomness and commits it. Returns dict mapping the table
+       names to the numbers of inserted rows.
+
+       Every part type can be bought from one to three sources and every
+       pile gets a history of up to depth events. The split part of the piles
+       is divided the way Part.take does it, the assigned piles are taken
+       from the free piles of the same part type."""
+    history = []
+
+    def event(kind, when, parent = None):
+        history.append((len(history) + 1, parent, when, kind, u""))
+        return len(history)
+
+    def later(when):
+        return when + datetime.timedelta(hours = rnd.randint(1, 24 * 30))
+
+    footprint_rows = [(i + 1, name, u"", u"", pins)
+                      for i, (name, pins) in enumerate(itertools.islice(footprint_names(), footprints))]
+
+    source_rows = [(i + 1, u"Vendor %d" % (i + 1), u"V%d" % (i + 1), u"", u"", u"", u"", None)
+                   for i in range(sources)]
+
+    type_rows = []
+    for i in range(types):
+        footprint = rnd.choice(footprint_rows)
+        type_rows.append((i + 1, u"%s%d" % (rnd.choice(WORDS).upper()[:4], i),
+                          u"%s%s %s" % (rnd.choice(VALUES), rnd.choice(UNITS),
+                                        u" ".join(rnd.sample(WORDS, 3))),
+                          u" ".join(rnd.sample(WORDS, 5)),
+                          rnd.choice(MANUFACTURERS), footprint[0], footprint[4], u""))
+
+    # the schema keeps one tier per price id, so every part source
+    # gets its own price list with the minimal amount to buy
+    price_rows = []
+    part_source_rows = []
+    offers = {}
+    for type_id in range(1, types + 1):
+        offers[type_id] = []
+        for source_id in rnd.sample(range(1, sources + 1), rnd.randint(1, min(3, sources))):
+            price = round(rnd.uniform(0.01, 10.0), 3)
+            price_rows.append((len(price_rows) + 1, later(START), rnd.choice([1, 10, 100, 1000]),
+                               price, None, u"EUR"))
+            part_source_rows.append((type_id, source_id, u"%s-%07d" % (source_rows[source_id - 1][2], type_id),
+                                     len(price_rows)))
+            offers[type_id].append((source_id, price))
+
+    # piles of parts: count, source_id, date, price, vat, part_type_id,
+    # assignment_id, history_id, soldered, usable
+    pile_rows = []
+    for i in range(piles):
+        type_id = rnd.randint(1, types)
+        source_id, price = rnd.choice(offers[type_id])
+        date = START + datetime.timedelta(days = rnd.randint(0, 5 * 365))
+
+        history_id = event(model.History.INCOMING, date)
+        when = date
+        for j in range(rnd.randint(1, depth) - 1):
+            when = later(when)
+            history_id = event(rnd.choice(CHANGES), when, history_id)
+
+        pile = [rnd.randint(1, 1000), source_id, date.date(), price, None, type_id,
+                None, history_id, 0, 1]
+        if rnd.random() < 0.02:
+            pile[7] = event(model.History.DESTROYED, later(when), history_id)
+            pile[9] = 0
+
+        pile_rows.append(pile)
+
+        # the taken pile keeps everything including the history
+        if pile[0] > 1 and rnd.random() < split:
+            taken = list(pile)
+            taken[0] = rnd.randint(1, pile[0] - 1)
+            pile[0] -= taken[0]
+            pile_rows.append(taken)
+
+    stock = {}
+    for pile in pile_rows:
+        if pile[9]:
+            stock.setdefault(pile[5], []).append(pile)
+    stocked = sorted(stock)
+
+    project_rows = []
+    item_rows = []
+    assignment_rows = []
+    for project_id in range(1, projects + 1):
+        started = START + datetime.timedelta(days = rnd.randint(0, 5 * 365))
+        project_rows.append((project_id, u"Project %d" % project_id,
+                             u" ".join(rnd.sample(WORDS, 3)), u"", started.date()))
+
+        for serial in range(items):
+            item_rows.append((len(item_rows) + 1, project_id, u"%d" % (serial + 1), u"",
+                              event(model.History.NEW, started)))
+
+            for j in range(assignments):
+                # most of the required part types are in the stock
+                if stocked and rnd.random() < 0.9:
+                    type_id = rnd.choice(stocked)
+                else:
+                    type_id = rnd.randint(1, types)
+
+                count = rnd.randint(1, 10)
+                assignment_rows.append((len(assignment_rows) + 1, type_id, len(item_rows), count))
+
+                free = [pile for pile in stock.get(type_id, []) if pile[6] is None]
+                if not free or rnd.random() < 0.3:
+                    continue
+
+                pile = rnd.choice(free)
+                if pile[0] > count:
+                    taken = list(pile)
+                    taken[0] = count
+                    pile[0] -= count
+                    pile_rows.append(taken)
+                    stock[type_id].append(taken)
+                    pile = taken
+
+                pile[6] = len(assignment_rows)
+                # soldered after both the project started and the last change of the pile
+                if rnd.random() < 0.5:
+                    pile[7] = event(model.History.USED, later(max(started, history[pile[7] - 1][2])), pile[7])
+                    pile[8] = 1
+
+    model.insert_many(store, u"INSERT INTO footprints (id, name, summary, description, pins) VALUES ",
+                      footprint_rows)
+    model.insert_many(store, u"INSERT INTO sources (id, name, shortname, summary, description, home, url, vat) VALUES ",
+                      source_rows)
+    model.insert_many(store, u"INSERT INTO types (id, name, summary, description, manufacturer, footprint_id, pins, datasheet) VALUES ",
+                      type_rows)
+    model.insert_many(store, u"INSERT INTO prices (id, time, amount, price, vat, currency) VALUES ",
+                      price_rows)
+    model.insert_many(store, u"INSERT INTO types_sources (part_type_id, source_id, sku, price_id) VALUES ",
+                      part_source_rows)
+    model.insert_many(store, u"INSERT INTO history (id, parent_id, time, event, description) VALUES ",
+                      history)
+    model.insert_many(store, u"INSERT INTO projects (id, name, summary, description, started) VALUES ",
+                      project_rows)
+    model.insert_many(store, u"INSERT INTO items (id, project_id, serial, description, history_id) VALUES ",
+                      item_rows)
+    model.insert_many(store, u"INSERT INTO assignments (id, part_type_id, item_id, count) VALUES ",
+                      assignment_rows)
+    model.insert_many(store, u"INSERT INTO parts (count, source_id, date, price, vat, part_type_id, assignment_id, history_id, soldered, usable) VALUES ",
+                      pile_rows)
+
+    # registers the terms of all the part types and commits
+    indexer.reindex(store)
+
+    return {
+        "footprints": len(footprint_rows),
+        "sources": len(source_rows),
+        "types": len(type_rows),
+        "prices": len(price_rows),
+        "types_sources": len(part_source_rows),
+        "history": len(history),
+        "projects": len(project_rows),
+        "items": len(item_rows),
+        "assignments": len(assignment_rows),
+        "parts": len(pile_rows)
+        }
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] DATABASE")
+    parser.add_option("--seed", type="int", default = 0)
+    parser.add_option("--footprints", type="int", default = 1000,
+                      help = "number of footprints")
+    parser.add_option("--types", type="int", default = 20000,
+                      help = "number of part types")
+    parser.add_option("--sources", type="int", default = 5,
+                      help = "number of vendors")
+    parser.add_option("--piles", type="int", default = 20000,
+                      help = "number of bought piles of parts, before splitting")
+    parser.add_option("--split", type="float", default = 0.2,
+                      help = "part of the piles which gets split")
+    parser.add_option("--projects", type="int", default = 20,
+                      help = "number of projects")
+    parser.add_option("--items", type="int", default = 10,
+                      help = "number of items of every project")
+    parser.add_option("--assignments", type="int", default = 20,
+                      help = "number of part types required by every item")
+    parser.add_option("--depth", type="int", default = 10,
+                      help = "maximal number of history events of a pile")
+    parser.add_option("--force", action="store_true", default = False,
+                      help = "replace the existing database")
+    opts, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("exactly one database file has to be given")
+
+    dbfile = args[0]
+    if os.path.exists(dbfile):
+        if not opts.force:
+            parser.error("%s already exists, use --force to replace it" % dbfile)
+        os.unlink(dbfile)
+
+    start = time.time()
+    store = model.getStore("sqlitefk:%s" % dbfile, create = True)
+    counts = generate(store, random.Random(opts.seed), opts.footprints, opts.types,
+                      opts.sources, opts.piles, opts.split, opts.projects,
+                      opts.items, opts.assignments, opts.depth)
+    store.close()
+
+    for table in sorted(counts):
+        print "%-16s %8d" % (table, counts[table])
+    print "generated in %.3f s" % (time.time() - start)
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@
 import model
 import urwid
 import app
+import collections
+from storm.store import ResultSet
+from storm.info import get_obj_info, ClassAlias
+from storm.expr import Select, Coalesce, LeftJoin, Desc
 from app import Edit, IntEdit, CheckBox, Button
 from edit import DateEdit
 import copy
@@ -13,6 +17,193 @@ class GenericKeybindings(dict):
         d.update(added)
         return d
 
+class Changed(list):
+    """Model objects modified, added or removed by a screen action.
+    Actions return it instead of REFRESH to update just their rows."""
+
+    def __init__(self, *objects):
+        list.__init__(self, objects)
+
+class PagedListWalker(urwid.ListWalker):
+    """List walker showing the rows of Storm result set between the
+    prefix and suffix widgets.
+
+    The rows are loaded in pages when they get close to the focus,
+    only the max_pages recently used pages are kept. Factory creates
+    the widgets for a list of loaded objects. The result is sorted by
+    the order columns (the last one has to be unique), a page following
+    an already loaded one is selected using the key of its last row
+    instead of OFFSET when the order columns belong to the listed
+    objects. Count is the number of rows of the result when it can be
+    computed cheaper than by counting the result itself, it gets lowered
+    when the rows end sooner."""
+
+    def __init__(self, result, order, factory, prefix = [], suffix = [],
+                 page_size = 50, max_pages = 8, desc = False, count = None):
+        self._result = result
+        self._order = order
+        self._factory = factory
+        self._prefix = list(prefix)
+        self._suffix = list(suffix)
+        self._page_size = page_size
+        self._max_pages = max_pages
+        self._desc = desc
+
+        self._pages = collections.OrderedDict()
+        self._keys = {}
+        self._reuse = {}
+        if count is None:
+            count = result.count()
+        self._count = count
+        self.focus = 0
+
+    def __len__(self):
+        return len(self._prefix) + self._count + len(self._suffix)
+
+    def _key(self, obj):
+        """Returns the values of order columns of obj or None when
+           they can't be used for keyset pagination"""
+        info = get_obj_info(obj)
+        key = []
+        for column in self._order:
+            if getattr(column, "cls", None) is not type(obj):
+                return None
+            value = info.variables[column].get()
+            if value is None:
+                return None
+            key.append(value)
+        return tuple(key)
+
+    def _after(self, key):
+        """Returns the condition selecting the rows following key. Keys
+           never contain NULL, NULLs sort first so in descending order
+           they follow every value."""
+        condition = None
+        for column, value in reversed(zip(self._order, key)):
+            if self._desc:
+                following = model.Or(column < value, column == None)
+            else:
+                following = column > value
+            if condition is not None:
+                following = model.Or(following, model.And(column == value, condition))
+            condition = following
+        return condition
+
+    def _load(self, number):
+        """Returns the widgets of the page number"""
+        if number in self._pages:
+            page = self._pages.pop(number)
+            self._pages[number] = page
+            return page[1]
+
+        if self._desc:
+            order = [Desc(column) for column in self._order]
+        else:
+            order = self._order
+
+        previous = self._keys.get(number - 1)
+        if previous is not None:
+            result = self._result.find(self._after(previous))
+            result.order_by(*order)
+            objects = list(result[:self._page_size])
+        else:
+            self._result.order_by(*order)
+            start = number * self._page_size
+            objects = list(self._result[start:start + self._page_size])
+
+        if objects:
+            self._keys[number] = self._key(objects[-1])
+
+        # the count might come from another snapshot of the database,
+        # a short page means the rows end here
+        end = number * self._page_size + len(objects)
+        if len(objects) < self._page_size and end < self._count:
+            self._count = end
+            self._modified()
+
+        widgets = [self._reuse.pop(obj, None) for obj in objects]
+        missing = [obj for obj, widget in zip(objects, widgets) if widget is None]
+        if missing:
+            created = iter(self._factory(missing))
+            widgets = [widget if widget is not None else created.next() for widget in widgets]
+
+        self._pages[number] = (objects, widgets)
+        while len(self._pages) > self._max_pages:
+            self._pages.popitem(last = False)
+
+        return widgets
+
+    def update(self, changed, count = None, suffix = None):
+        """Forgets the loaded pages after the objects in changed were
+           modified, added or removed, so the rows get loaded again in
+           the right order. The widgets of the unchanged rows are reused."""
+        if suffix is not None:
+            self._suffix = list(suffix)
+
+        changed = set(changed)
+        self._reuse = {}
+        for objects, widgets in self._pages.itervalues():
+            for obj, widget in zip(objects, widgets):
+                if obj not in changed:
+                    self._reuse[obj] = widget
+
+        self._pages.clear()
+        self._keys.clear()
+        if count is None:
+            count = self._result.count()
+        self._count = count
+        self.set_focus(self.focus)
+
+    def __getitem__(self, position):
+        if not isinstance(position, int) or position < 0:
+            raise IndexError(position)
+
+        if position < len(self._prefix):
+            return self._prefix[position]
+        position -= len(self._prefix)
+
+        if position < self._count:
+            page = self._load(position // self._page_size)
+            # a short page shortens the list, the position might be past its end
+            if position < self._count:
+                return page[position % self._page_size]
+        position -= self._count
+
+        return self._suffix[position]
+
+    def next_position(self, position):
+        if position + 1 >= len(self):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def positions(self, reverse = False):
+        if reverse:
+            return xrange(len(self) - 1, -1, -1)
+        return xrange(len(self))
+
+    def set_focus(self, position):
+        # the list might have shrunk since the position was saved
+        self.focus = max(0, min(position, len(self) - 1))
+        self._modified()
+
+    def get_focus(self):
+        # loading the focused row might shorten the list
+        while len(self):
+            length = len(self)
+            try:
+                return self[self.focus], self.focus
+            except IndexError:
+                if len(self) == length:
+                    raise
+                self.set_focus(self.focus)
+
+        return None, None
+
 class GenericInterface(app.UIScreen):
     #KEYS: key -> title, method, f(self) -> bool
     KEYS = GenericKeybindings({
@@ -47,14 +238,23 @@ class GenericInterface(app.UIScreen):
     def rows(self, args = None):
         return []
 
-    def show(self, args = None):
-        self._save.clear()
+    def update(self, changed):
+        """Refreshes the screen after an action changed the model objects
+           in changed, the whole screen is shown again by default"""
+        self.app.switch_screen(self)
+
+    def make_walker(self, args = None):
+        """Returns the list walker with the screen content"""
         listbox_content = []
         listbox_content.extend(self.header(args))
         listbox_content.extend(self.rows(args))
         listbox_content.extend(self.details(args))
 
-        self.walker = urwid.SimpleListWalker(listbox_content)
+        return urwid.SimpleListWalker(listbox_content)
+
+    def show(self, args = None):
+        self._save.clear()
+        self.walker = self.make_walker(args)
         if self.focus:
             self.walker.set_focus(self.focus)
         listbox = urwid.ListBox(self.walker)
@@ -68,21 +268,38 @@ class GenericInterface(app.UIScreen):
         if key in self.KEYS and self.KEYS[key][2](self):
             widget, id = self.walker.get_focus()
             w = getattr(self, self.KEYS[key][1])(widget, id)
-            if w == self.REFRESH:
-                self.app.switch_screen(self)
-                return True
-            elif w is None:
-                return True
-            elif w == False:
-                return key
-            else:
-                self.focus = id
-                self.app.switch_screen_with_return(w)
-                return True
+            return self.perform(w, key)
 
         else:
             return key
 
+    def perform(self, w, key = None):
+        """Processes the value returned by an action - refreshes
+           the screen or its changed rows or opens the returned screen."""
+        if w == self.REFRESH:
+            self.app.switch_screen(self)
+            return True
+        elif isinstance(w, Changed):
+            self.update(w)
+            return True
+        elif w is None:
+            return True
+        elif w == False:
+            return key
+        else:
+            widget, self.focus = self.walker.get_focus()
+            self.app.switch_screen_with_return(w)
+            return True
+
+    def run_dialog(self, dialog, action, *args, **kwargs):
+        """Opens the dialog and when it is confirmed, calls
+           action(*args, **kwargs) and processes its result the same
+           way as results of actions bound to keys."""
+        def confirmed():
+            self.perform(action(*args, **kwargs))
+
+        self.app.run_dialog(dialog, confirmed)
+
 class GenericEditor(GenericInterface):
     MODEL = model.Project
     FIELDS = [
@@ -161,6 +378,10 @@ class GenericBrowser(GenericInterface):
     SORT = True
     EDITOR = None
     SEARCH_FIELDS = ["name", "summary", "description"]
+    # computed fields loaded for all the listed objects at once,
+    # field -> (column holding the object id, aggregate expression)
+    # objects without any row to aggregate get 0
+    AGGREGATES = {}
 
     KEYS = GenericInterface.KEYS + {
         "e": (_(u"edit"), "edit", lambda self: self.EDITOR)
@@ -171,16 +392,106 @@ class GenericBrowser(GenericInterface):
         GenericInterface.__init__(self, a, store)
         self.order_by = None
         self.order_desc = False
+        self._sort_key = None
         self.search = search
+        self._aggregates = {}
+        self._aggregated = set()
+        self._prefetched = []
 
     def header(self, args = None):
-        w = urwid.Columns([(f[1], f[2], urwid.Text(f[0])) for f in self.FIELDS], 2)
+        def _title(f):
+            if f[3] != self.order_by:
+                return f[0]
+
+            marker = self.order_desc and u"v" or u"^"
+            if f[1] != "fixed":
+                return f[0] + u" " + marker
+
+            # the marker replaces the last character of the column,
+            # a longer title would wrap to the next line
+            return f[0].ljust(f[2])[:f[2] - 1] + marker
+
+        w = urwid.Columns([(f[1], f[2], urwid.Text(_title(f))) for f in self.FIELDS], 2)
         return [w]
 
+    def load_aggregates(self, objects):
+        """Loads the AGGREGATES shown in FIELDS for all objects using
+           one GROUP BY query per column holding the object ids"""
+        fields = [f[3] for f in self.FIELDS if f[3] in self.AGGREGATES]
+        self._aggregates = dict((f, {}) for f in fields)
+        self._aggregated = set(o.id for o in objects)
+
+        groups = []
+        for f in fields:
+            key, expr = self.AGGREGATES[f]
+            for group_key, group in groups:
+                if group_key is key:
+                    group.append((f, expr))
+                    break
+            else:
+                groups.append((key, [(f, expr)]))
+
+        for key, group in groups:
+            for chunk in model.chunks(list(self._aggregated)):
+                res = self.store.find((key, ) + tuple(expr for f, expr in group),
+                                      key.is_in(chunk)).group_by(key)
+                for row in res:
+                    for (f, expr), value in zip(group, row[1:]):
+                        self._aggregates[f][row[0]] = value
+
+    def _references(self, objects, name):
+        """Loads the objects referenced by the Reference name of objects
+           using one IN query per chunk, returns them or None when name
+           is not a simple reference"""
+        if not objects:
+            return []
+
+        reference = getattr(type(objects[0]), name, None)
+        if not isinstance(reference, model.Reference):
+            return None
+
+        relation = reference._relation
+        if len(relation.local_key) != 1 or not relation.remote_key_is_primary:
+            return None
+
+        ids = set(relation.get_local_variables(o)[0].get() for o in objects)
+        ids.discard(None)
+
+        remote = []
+        for chunk in model.chunks(list(ids)):
+            remote.extend(self.store.find(relation.remote_cls,
+                                          relation.remote_key[0].is_in(chunk)))
+        return remote
+
+    def prefetch(self, objects):
+        """Loads all objects referenced along the dotted paths in FIELDS,
+           one query per relation, so following the paths of the listed
+           objects needs no more queries. The loaded objects are kept
+           referenced, so the store cache holds them."""
+        loaded = {}
+        paths = set(tuple(f[3].split(".")[:-1]) for f in self.FIELDS)
+        for path in sorted(paths):
+            current = objects
+            for i, name in enumerate(path):
+                prefix = path[:i + 1]
+                if prefix not in loaded:
+                    loaded[prefix] = self._references(current, name)
+                current = loaded[prefix]
+                if current is None:
+                    break
+
+        self._prefetched = [o for l in loaded.itervalues() if l for o in l]
+
+    def _field(self, s, name):
+        """Returns the value of field name of the listed object s"""
+        if name in self._aggregates and s.id in self._aggregated:
+            return self._aggregates[name].get(s.id) or 0
+        return self._val(s, name)
+
     def _entry(self, s):
         p = lambda w: urwid.AttrMap(w, "body", "list_f")
         def _prep(f):
-            val = self._val(s, f[3])
+            val = self._field(s, f[3])
             if isinstance(val, bool) and val == True:
                 return _(u"[x]")
             elif isinstance(val, bool) and val == False:
@@ -196,10 +507,58 @@ class GenericBrowser(GenericInterface):
         return w
 
     def rows(self, args = None, decorator = _entry):
-        return [decorator(self, p) for p in self.content]
+        content = list(self.content)
+        self.prefetch(content)
+        self.load_aggregates(content)
+        return [decorator(self, p) for p in content]
+
+    def _page(self, objects):
+        """Returns the row widgets for a page of listed objects"""
+        self.prefetch(objects)
+        self.load_aggregates(objects)
+        return [self._entry(o) for o in objects]
+
+    def make_walker(self, args = None):
+        content = self.content
+        if not isinstance(content, ResultSet):
+            return GenericInterface.make_walker(self, args)
+
+        # only the rows around the focus are loaded from the database,
+        # they are shown once the query executor counts them
+        walker = PagedListWalker(content, self.ordering, self._page,
+                                 prefix = self.header(args),
+                                 suffix = [urwid.Text(_(u"Loading..."))],
+                                 desc = self.order_desc,
+                                 count = 0)
+        self.query(self.load, lambda result: self.loaded(walker, result, args),
+                   *self._count_query)
+        return walker
+
+    def load(self, store, tables, find_args):
+        """Returns the number of listed rows. Runs in the query executor
+           with its own store, which gets the tables and conditions
+           of the listed rows."""
+        return store.using(*tables).find(self.MODEL, *find_args).count()
+
+    def loaded(self, walker, result, args):
+        """Shows the rows in walker once load returned its result"""
+        walker.update([], count = result, suffix = self.details(args))
+        if self.focus:
+            walker.set_focus(self.focus)
+
+    def update(self, changed):
+        if not isinstance(self.walker, PagedListWalker):
+            return GenericInterface.update(self, changed)
+
+        # the rows of the changed objects are created again,
+        # removed or added where they belong when shown
+        self.walker.update(changed, count = self._unsorted.count())
 
     def show(self, args = None):
+        if args is None:
+            self.order_desc = False
         self.order_by = args
+        self._sort_key = args and self.sort_key(args)
         return GenericInterface.show(self, args)
 
     def input(self, key):
@@ -210,6 +569,11 @@ class GenericBrowser(GenericInterface):
             try:
                 col = int(key) - 1
                 f = self.FIELDS[col][3]
+                if self.sort_key(f) is None:
+                    return key
+
+                # sorting by the same column again reverses the order
+                self.order_desc = f == self.order_by and not self.order_desc
                 self.focus = None
                 self.app.switch_screen(self, f)
                 return True
@@ -243,17 +607,70 @@ class GenericBrowser(GenericInterface):
         if self.MODEL_ARGS:
             find_args.extend(self.MODEL_ARGS)
 
-        res = self.store.find(self.MODEL, *find_args)
-        if self.order_by:
-            try:
-                # try sorting only if it is DB column
-                f = self._val(self.MODEL, self.order_by)
-                if isinstance(f, model.SortableBase):
-                    res.order_by(f)
-            except AttributeError:
-                pass
+        # the same rows without the joins used just for sorting
+        # are much faster to count
+        tables = [t for t in self.tables if not isinstance(t, LeftJoin)]
+        self._unsorted = self.store.using(*tables).find(self.MODEL, *find_args)
+        self._count_query = (tables, find_args)
+
+        res = self.store.using(*self.tables).find(self.MODEL, *find_args)
+        if self.order_desc:
+            res.order_by(*[Desc(column) for column in self.ordering])
+        else:
+            res.order_by(*self.ordering)
         return res
 
+    def sort_key(self, name):
+        """Returns (expression, joined tables) the listed objects are
+           sorted by when sorting by field name or None when the field
+           is computed in Python. Dotted reference paths are left joined,
+           AGGREGATES are computed by correlated subqueries."""
+        if name in self.AGGREGATES:
+            key, expr = self.AGGREGATES[name]
+            return Coalesce(Select(expr, key == self.MODEL.id, tables = [key.table]), 0), []
+
+        path = name.split(".")
+        cls = self.MODEL
+        current = self.MODEL
+        joins = []
+        for p in path[:-1]:
+            reference = getattr(cls, p, None)
+            if not isinstance(reference, model.Reference):
+                return None
+
+            relation = reference._relation
+            if len(relation.local_key) != 1 or not relation.remote_key_is_primary:
+                return None
+
+            # aliased, so the joins do not clash with tables used by conditions
+            cls = relation.remote_cls
+            alias = ClassAlias(cls)
+            joins.append(LeftJoin(alias, getattr(alias, relation.remote_key[0].name) ==
+                                         getattr(current, relation.local_key[0].name)))
+            current = alias
+
+        if not isinstance(getattr(cls, path[-1], None), model.SortableBase):
+            return None
+
+        return getattr(current, path[-1]), joins
+
+    @property
+    def tables(self):
+        """Returns the tables the content is selected from"""
+        tables = [self.MODEL]
+        if self._sort_key is not None:
+            tables.extend(self._sort_key[1])
+        return tables
+
+    @property
+    def ordering(self):
+        """Returns the list of expressions the content is sorted by,
+           the primary key goes last to make the order stable"""
+        order = []
+        if self._sort_key is not None:
+            order.append(self._sort_key[0])
+        return order + [self.MODEL.id]
+
     @property
     def conditions(self):
         find_args = []
@@ -277,7 +694,7 @@ class GenericSelector(GenericBrowser):
     def remove(self, widget, id):
         self.store.remove(widget._data)
         self.store.commit()
-        return self.REFRESH
+        return Changed(widget._data)
 
     def add(self, widget, id):
         return self.EDITOR(self.app, self.store, None, caller = self)
@@ -0,0 +1,141 @@
+# encoding: utf8
+
+import threading
+from storm.exceptions import OperationalError
+import model
+
+def tokenize(*texts):
+    """Returns the set of simplified search terms contained in texts"""
+    words = set()
+    for text in texts:
+        for word in model.Term.split(text or u""):
+            word = model.Term.simplify(word)
+            if word:
+                words.add(word)
+    return words
+
+def _reindex(store, conds, selection, params):
+    """Rebuilds the search indexes of part types matching Storm
+       conditions conds. Selection is the equivalent SQL subquery
+       (using params) selecting the ids of the same part types,
+       including deleted ones."""
+    rows = list(store.find(model.PartType, *conds)
+                .values(model.PartType.id, model.PartType.name,
+                        model.PartType.summary, model.PartType.description,
+                        model.PartType.manufacturer))
+
+    words = dict((row[0], tokenize(*row[1:])) for row in rows)
+    vocabulary = set()
+    for w in words.itervalues():
+        vocabulary.update(w)
+
+    # create the missing terms, the database adds their n-grams
+    model.insert_many(store, u"INSERT OR IGNORE INTO terms (term) VALUES ",
+                [(w, ) for w in vocabulary])
+
+    # aliases are already resolved by the database
+    term_ids = {}
+    for chunk in model.chunks(list(vocabulary)):
+        term_ids.update(store.find(model.Term, model.Term.term.is_in(chunk))
+                        .values(model.Term.term, model.Term.canonical_id))
+
+    # replace the mappings of all reindexed part types
+    if selection is None:
+        store.execute("DELETE FROM terms_types")
+    else:
+        store.execute("DELETE FROM terms_types WHERE type_id IN %s" % selection,
+                      params)
+
+    mappings = set()
+    for type_id, type_words in words.iteritems():
+        for w in type_words:
+            mappings.add((term_ids[w], type_id))
+
+    model.insert_many(store, u"INSERT OR IGNORE INTO terms_types (term_id, type_id) VALUES ",
+                list(mappings))
+
+    # full text index
+    backend = model.search_backend(store)
+    if isinstance(backend, model.FTSSearch):
+        table = backend.TABLE
+        if selection is None:
+            store.execute("DELETE FROM %s" % table)
+        else:
+            store.execute("DELETE FROM %s WHERE rowid IN %s" % (table, selection),
+                          params)
+
+        model.insert_many(store, u"INSERT INTO %s (rowid, %s) VALUES "
+                    % (table, u", ".join(backend.COLUMNS)),
+                    [[row[0]] + [backend.fold(text) for text in row[1:]]
+                     for row in rows])
+
+    return len(rows)
+
+def reindex(store, since = None):
+    """Rebuilds the search term mappings and the full text index
+       for all part types or only for those changed since the given
+       datetime. Runs in a single transaction and returns the number
+       of reindexed part types."""
+    if since is None:
+        # everything gets fresh, forget the queued changes
+        last = store.execute("SELECT coalesce(max(id), 0) FROM index_queue").get_one()[0]
+        count = _reindex(store, [], None, ())
+        store.execute("DELETE FROM index_queue WHERE id <= ?", (last, ))
+    else:
+        count = _reindex(store, [model.PartType.changed >= since],
+                         "(SELECT id FROM types WHERE changed >= ?)", (since, ))
+
+    store.commit()
+
+    return count
+
+def index_queued(store, batch = 100):
+    """Reindexes part types from the oldest batch of index_queue
+       entries, returns the number of processed entries."""
+    queued = list(store.find(model.IndexQueue)
+                  .order_by(model.IndexQueue.id)[:batch]
+                  .values(model.IndexQueue.id, model.IndexQueue.type_id))
+    if not queued:
+        return 0
+
+    ids = list(set(type_id for queue_id, type_id in queued))
+    _reindex(store, [model.PartType.id.is_in(ids)],
+             "(%s)" % ", ".join("?" * len(ids)), ids)
+    store.execute("DELETE FROM index_queue WHERE id <= ?", (queued[-1][0], ))
+    store.commit()
+
+    return len(queued)
+
+class BackgroundIndexer(threading.Thread):
+    """Thread draining index_queue using its own database connection,
+       so the search indexes get updated without blocking the UI."""
+
+    def __init__(self, url, interval = 1.0, batch = 100):
+        threading.Thread.__init__(self, name = "indexer")
+        self.daemon = True
+        self._url = url
+        self._interval = interval
+        self._batch = batch
+        self._quit = threading.Event()
+
+    def run(self):
+        store = model.getStore(self._url)
+        try:
+            while not self._quit.is_set():
+                try:
+                    while index_queued(store, self._batch) and not self._quit.is_set():
+                        pass
+                except OperationalError:
+                    # database is busy, try again later
+                    pass
+
+                # end the read transaction, so the next round sees
+                # changes committed by other connections
+                store.rollback()
+                self._quit.wait(self._interval)
+        finally:
+            store.close()
+
+    def stop(self):
+        self._quit.set()
+        self.join()
@@ -16,35 +16,130 @@ import datetime
 
 class SearchBrowser(Browser):
     SEARCH_FIELDS = Browser.SEARCH_FIELDS + ["manufacturer"]
+    # how many of the best matches are shown at once
+    LIMIT = 50
+    # seconds without a keypress before the typed search is shown
+    DEBOUNCE = 0.3
+    KEYS = Browser.KEYS + {
+        "+": (_(u"more results"), "more", lambda self: self._truncated)
+        }
 
     def __init__(self, app_inst, store, search):
         Browser.__init__(self, app_inst, store, search = search)
         self._save = app.SaveRegistry()
+        self._limit = self.LIMIT
+        self._results = None
+        self._truncated = False
+        self._cache = model.SearchCache()
+        self._typing = None
         self.search_field = app.Edit(u"", search).bind(self, "search")
         urwid.connect_signal(self.search_field, "enter", self.do_search)
+        urwid.connect_signal(self.search_field, "change", self.typed)
 
     def header(self, args = None):
         return [urwid.AttrWrap(self.search_field.reg(self._save), "edit", "edit_f"),
                 urwid.Divider(" ")] + Browser.header(self)
 
+    def make_walker(self, args = None):
+        if self.search:
+            # end the current read transaction, so the changes indexed
+            # by the background indexer are visible
+            self.store.commit()
+
+            # the ranked ids get saved under the key by loaded
+            if self._results is not None:
+                model.SearchResult.drop(self.store, self._results)
+            self._results = model.SearchResult.key(self.store)
+
+        return Browser.make_walker(self, args)
+
     @property
     def conditions(self):
         conds = []
 
         if self.search:
-            search_terms = [self.MODEL.id == part_type.id
-                            for part_type in model.Term.search(self.store, self.search)]
-            if search_terms:
-                conds.append(model.Or(search_terms))
-            else:
-                conds.append(False)
+            conds.append(self.MODEL.id == model.SearchResult.type_id)
+            conds.append(model.SearchResult.search == self._results)
 
         return conds
 
+    def load(self, store, tables, find_args):
+        if not self.search:
+            return Browser.load(self, store, tables, find_args)
+
+        # the results table is private to the connection of the screen,
+        # only the ranking is done by the query executor
+        return self._cache.search(store, self.search)[:self._limit + 1]
+
+    def loaded(self, walker, result, args):
+        if not self.search:
+            return Browser.loaded(self, walker, result, args)
+
+        self._truncated = len(result) > self._limit
+        del result[self._limit:]
+        model.SearchResult.save(self.store, result, key = self._results)
+        self.app.update_title(self)
+
+        Browser.loaded(self, walker, len(result), args)
+
+    @property
+    def tables(self):
+        tables = Browser.tables.fget(self)
+        if self.search:
+            tables.append(model.SearchResult)
+        return tables
+
+    @property
+    def ordering(self):
+        if self.search and not self.order_by:
+            # keep the best matches on top
+            return [model.SearchResult.rank, self.MODEL.id]
+        return Browser.ordering.fget(self)
+
+    @property
+    def title(self):
+        s = Browser.title.fget(self)
+        if self._truncated:
+            s += _(u" (best %d matches)") % self._limit
+        return s
+
+    def more(self, widget, id):
+        self._limit += self.LIMIT
+        return self.REFRESH
+
+    def typed(self, widget, text):
+        """Shows the results of the typed search once the user stops
+           typing for DEBOUNCE seconds"""
+        loop = self.app.loop
+        if loop is None:
+            return
+
+        if self._typing is not None:
+            loop.remove_alarm(self._typing)
+        self._typing = loop.set_alarm_in(self.DEBOUNCE, self.type_ahead)
+
+    def type_ahead(self, loop = None, data = None):
+        self._typing = None
+        if self.app.current_screen is not self or self.search_field.edit_text == self.search:
+            return
+
+        for w in self._save:
+            w.save()
+
+        self._limit = self.LIMIT
+        self.app.switch_screen(self)
+
     def do_search(self, widget = None):
         for w in self._save:
             w.save()
 
+        # search again, the parts might have changed
+        if self._typing is not None:
+            self.app.loop.remove_alarm(self._typing)
+            self._typing = None
+        self._cache.clear()
+
+        self._limit = self.LIMIT
         self.app.switch_screen(self)
 
 class Actions(app.UIScreen):
@@ -140,16 +235,15 @@ class SourceSelector(GenericSelector):
     def select(self, widget, id):
         dialog = DateDialog(self.app, _(u"Date"), _(u"When did you get the new parts?"),
                             datetime.date.today())
-        ok = self.app.run_dialog(dialog)
-        if not ok:
-            return
+        self.run_dialog(dialog, self.receive, widget._data, dialog)
 
+    def receive(self, source, dialog):
         return SearchForParts(self.app, self.store,
                               back=self, action=PartCreator,
                               extra = {
                                   "date": dialog.value,
-                                  "source": widget._data,
-                                  "vat": widget._data.vat})
+                                  "source": source,
+                                  "vat": source.vat})
 
     @property
     def title(self):
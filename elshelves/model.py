@@ -1,9 +1,16 @@
-from storm.locals import create_database, Desc, Storm, Unicode, Int, Bool, DateTime, Date, Reference, ReferenceSet, Store, Float, Or
+from storm.locals import create_database, Storm, Unicode, Int, Bool, DateTime, Date, Reference, ReferenceSet, Store, Float, Or, And, Not, Select, Count
+from storm.expr import Intersect, Union, SQL
 from storm.properties import PropertyColumn
 from storm.databases.sqlite import SQLite
 from storm.database import register_scheme
+from storm.exceptions import OperationalError
+import re
 import os.path
+import weakref
+import threading
+import itertools
 import datetime
+import math
 import unicodedata
 
 SortableBase = PropertyColumn
@@ -48,6 +55,10 @@ class Price(Storm):
     vat = Float() # in percents or Null if included
     currency = Unicode()
 
+class CurrentPrice(Price):
+    """Model for the newest price tiers of every price list"""
+    __storm_table__ = "prices_current"
+
 class Source(Storm):
     """Model for one source/vendor of parts"""
     __storm_table__ = "sources"
@@ -98,19 +109,36 @@ class PartSource(Storm):
                                                                self.source.name,
                                                                self.sku)
 
+    @staticmethod
+    def current_prices(store, part_sources):
+        """Returns dict mapping price_id of the part sources to the list
+           of their current price tiers ordered by amount. All the tiers
+           are loaded using a single query."""
+        ids = list(set(s.price_id for s in part_sources if s.price_id is not None))
+        tiers = dict((price_id, []) for price_id in ids)
+        for chunk in chunks(ids):
+            for price in store.find(CurrentPrice, CurrentPrice.id.is_in(chunk)) \
+                              .order_by(CurrentPrice.id, CurrentPrice.amount):
+                tiers[price.id].append(price)
+        return tiers
+
+    @property
+    def current_tiers(self):
+        return PartSource.current_prices(Store.of(self), [self]).get(self.price_id, [])
+
     @property
     def min_amount(self):
-        q = self.prices.order_by(Desc(Price.time)).order_by(Price.amount).one()
-        if q:
-            return q.amount
+        tiers = self.current_tiers
+        if tiers:
+            return tiers[0].amount
         else:
             return 1
 
     @property
     def price(self):
-        cheapest = self.prices.order_by(Desc(Price.time)).order_by(Price.amount).any()
-        if cheapest:
-            return cheapest
+        tiers = self.current_tiers
+        if tiers:
+            return tiers[0].price
         else:
             return 0.0
 
@@ -129,6 +157,7 @@ class PartType(Storm):
     parts = ReferenceSet(id, "Part.part_type_id")
     datasheet = Unicode()
     manufacturer = Unicode()
+    changed = DateTime() # maintained by database triggers
 
     def __str__(self):
         return "<PartType id:%d name:%s pins:%d footprint:%s>" % (self.id,
@@ -136,12 +165,8 @@ class PartType(Storm):
                                                                   self.footprint.pins,
                                                                   self.footprint)
 
-    # This hook should reregister search terms after the Model is changed
-    # but it is not working due to some strange error in Storm
-    # so I am disabling it for now
-    #def __storm_pre_flushed__(self):
-    #    # update search term database after the change is flushed
-    #    Term.register(self)
+    # Search terms are reregistered by indexer.BackgroundIndexer,
+    # database triggers queue every changed part type to index_queue
 
     @property
     def price(self):
@@ -154,7 +179,8 @@ class PartType(Storm):
         if not Store.of(self):
             return 0
 
-        return self.find_all.find(Part.assignment == None, Part.soldered == False).sum(Part.count) or 0
+        free, assigned = StockCounter.of(self)
+        return free
 
     @property
     def count_w_assigned(self):
@@ -162,7 +188,8 @@ class PartType(Storm):
         if not Store.of(self):
             return 0
 
-        return self.find_all.find(Part.soldered == False).sum(Part.count) or 0
+        free, assigned = StockCounter.of(self)
+        return free + assigned
 
 
     @property
@@ -192,6 +219,7 @@ class History(Storm):
     DESTROYED = 5
     TESTED = 6
     SHIPPED = 7
+    ARCHIVED = 8 # summary of the older records moved to the archive
 
     id = Int(primary=True)
     parent_id = Int()
@@ -201,14 +229,140 @@ class History(Storm):
     description = Unicode()
     location_id = Int()
     location = Reference(location_id, Location.id)
+    root_id = Int() # maintained by the database
+    root = Reference(root_id, "History.id")
+    root_time = DateTime() # time the archived part of the chain started, summaries only
+
+    # ids of the records from the given one to the root of its chain
+    CHAIN = """(WITH RECURSIVE chain(id, depth) AS (
+     SELECT ?, 0
+     UNION ALL
+     SELECT history.parent_id, chain.depth + 1 FROM history JOIN chain ON history.id = chain.id
+     WHERE history.parent_id IS NOT NULL
+) SELECT id, depth FROM chain) AS chain"""
 
     @property
     def beginning(self):
+        if self.root_id is not None:
+            return self.root
+
+        # not flushed yet, the database does not know the root
         oldest = self
         while oldest.parent:
             oldest = oldest.parent
         return oldest
 
+    def chain(self):
+        """Returns the list of records from this one to the oldest one,
+           the whole chain is loaded using a single query."""
+        store = Store.of(self)
+        if store is None:
+            return [self] + (self.parent and self.parent.chain() or [])
+
+        result = store.using(History, SQL(History.CHAIN, (self.id, ))) \
+                      .find(History, History.id == SQL("chain.id"))
+        return list(result.order_by(SQL("chain.depth")))
+
+    @property
+    def date(self):
+        return self.time.date()
+
+    @property
+    def started(self):
+        """Date the chain of this record started, archived records included"""
+        beginning = self.beginning
+        return (beginning.root_time or beginning.time).date()
+
+    @staticmethod
+    def archive(store, before):
+        """Moves the records older than the before datetime to the archive
+           table and returns their number. Old records still referenced
+           by newer records, parts or items are kept as ARCHIVED summaries
+           which start new chains and remember when the original chain
+           started, the archive keeps their original content under
+           the same id."""
+        # old records whose ancestors are all old too
+        store.execute("CREATE TEMPORARY TABLE history_old (id integer PRIMARY KEY)")
+        store.execute("""INSERT INTO history_old (id)
+WITH RECURSIVE old(id) AS (
+     SELECT id FROM history WHERE parent_id IS NULL AND time < ?
+     UNION ALL
+     SELECT history.id FROM history JOIN old ON history.parent_id = old.id WHERE history.time < ?
+) SELECT id FROM old""", (before, before))
+
+        # old records which have to stay
+        store.execute("CREATE TEMPORARY TABLE history_frontier (id integer PRIMARY KEY)")
+        store.execute("""INSERT INTO history_frontier (id)
+SELECT parent_id FROM history WHERE parent_id IN (SELECT id FROM history_old) AND id NOT IN (SELECT id FROM history_old)
+UNION SELECT history_id FROM parts WHERE history_id IN (SELECT id FROM history_old)
+UNION SELECT history_id FROM items WHERE history_id IN (SELECT id FROM history_old)""")
+
+        # summaries are archived already, their archived copy is the original
+        store.execute("""INSERT OR IGNORE INTO history_archive (id, parent_id, time, event, description, location_id)
+SELECT id, parent_id, time, event, description, location_id FROM history WHERE id IN (SELECT id FROM history_old)""")
+
+        # the roots are old too, they still hold the start of the chains
+        store.execute("""UPDATE history SET root_time = (SELECT coalesce(root.root_time, root.time) FROM history AS root
+                                        WHERE root.id = history.root_id)
+       WHERE id IN (SELECT id FROM history_frontier)""")
+
+        # detaching records as the roots of their own chains bypasses the append only check
+        store.execute("""UPDATE history SET event = ?, description = ?, parent_id = NULL, root_id = id
+       WHERE id IN (SELECT id FROM history_frontier)""", (History.ARCHIVED, u"_older events archived"))
+        store.execute("""UPDATE history SET parent_id = NULL, root_id = id
+       WHERE id IN (SELECT id FROM history_old) AND id NOT IN (SELECT id FROM history_frontier)""")
+
+        # the summaries are the new roots of the newer records
+        store.execute("CREATE TEMPORARY TABLE history_roots (id integer PRIMARY KEY, root_id integer)")
+        store.execute("""INSERT INTO history_roots (id, root_id)
+WITH RECURSIVE tree(id, root_id) AS (
+     SELECT id, id FROM history_frontier
+     UNION ALL
+     SELECT history.id, tree.root_id FROM history JOIN tree ON history.parent_id = tree.id
+) SELECT id, root_id FROM tree""")
+        store.execute("""UPDATE history SET root_id = (SELECT root_id FROM history_roots WHERE history_roots.id = history.id)
+       WHERE id IN (SELECT id FROM history_roots)""")
+
+        count = store.execute("""DELETE FROM history
+       WHERE id IN (SELECT id FROM history_old) AND id NOT IN (SELECT id FROM history_frontier)""").rowcount
+
+        for table in ("history_old", "history_frontier", "history_roots"):
+            store.execute("DROP TABLE %s" % table)
+
+        store.invalidate()
+        store.commit()
+
+        return count
+
+class ArchivedHistory(Storm):
+    """Model for historical records moved to the archive"""
+    __storm_table__ = "history_archive"
+
+    id = Int(primary=True)
+    parent_id = Int()
+    time = DateTime()
+    event = Int()
+    description = Unicode()
+    location_id = Int()
+    location = Reference(location_id, Location.id)
+    archived = DateTime()
+
+    # ids of the archived records from the given one to the oldest one
+    CHAIN = """(WITH RECURSIVE chain(id, depth) AS (
+     SELECT ?, 0
+     UNION ALL
+     SELECT history_archive.parent_id, chain.depth + 1 FROM history_archive JOIN chain ON history_archive.id = chain.id
+     WHERE history_archive.parent_id IS NOT NULL AND chain.depth + 1 < ?
+) SELECT id, depth FROM chain) AS chain"""
+
+    @staticmethod
+    def chain(store, id, limit = 100):
+        """Returns the list of at most limit archived records starting
+           with the one with the given id and following its parents."""
+        result = store.using(ArchivedHistory, SQL(ArchivedHistory.CHAIN, (id, limit))) \
+                      .find(ArchivedHistory, ArchivedHistory.id == SQL("chain.id"))
+        return list(result.order_by(SQL("chain.depth")))
+
     @property
     def date(self):
         return self.time.date()
@@ -236,7 +390,7 @@ class Part(Storm):
 
     @property
     def assigned(self):
-        return self.assignment is not None
+        return self.assignment_id is not None
 
     def take(self, count):
         """Take some amount of parts from this pile and return the object
@@ -317,6 +471,60 @@ class Item(Storm):
     history_id = Int()
     history = Reference(history_id, History.id)
 
+class StockCounter(Storm):
+    """Model for the amounts of usable (free, assigned, soldered) and
+       unusable parts of one part type, maintained by database triggers"""
+    __storm_table__ = "stock_counters"
+
+    type_id = Int(primary=True)
+    part_type = Reference(type_id, PartType.id)
+    free = Int()
+    assigned = Int()
+    soldered = Int()
+    unusable = Int()
+
+    COLUMNS = ("free", "assigned", "soldered", "unusable")
+
+    # the counters computed from parts table
+    SUMS = """SELECT part_type_id,
+       sum((usable AND NOT soldered AND assignment_id IS NULL) * count),
+       sum((usable AND NOT soldered AND assignment_id IS NOT NULL) * count),
+       sum((usable AND soldered) * count),
+       sum((NOT usable) * count)
+FROM parts GROUP BY part_type_id"""
+
+    @staticmethod
+    def of(part_type):
+        """Returns the free and assigned unsoldered counts of part_type.
+           The values are read from the database as the cached objects
+           do not see the changes made by triggers."""
+        counts = Store.of(part_type).find(StockCounter, type_id = part_type.id) \
+                 .values(StockCounter.free, StockCounter.assigned)
+        return next(counts, (0, 0))
+
+    @classmethod
+    def verify(cls, store, repair = False):
+        """Recomputes the counters from parts table and returns the list
+           of (type id, stored counters, computed counters) which differ.
+           The stored counters are replaced when repair is requested."""
+        zero = (0, ) * len(cls.COLUMNS)
+        stored = dict((row[0], tuple(row[1:])) for row in
+                      store.execute("SELECT type_id, %s FROM stock_counters" % ", ".join(cls.COLUMNS)))
+        computed = dict((row[0], tuple(row[1:])) for row in store.execute(cls.SUMS))
+
+        differences = []
+        for type_id in sorted(set(stored) | set(computed)):
+            if stored.get(type_id, zero) != computed.get(type_id, zero):
+                differences.append((type_id, stored.get(type_id, zero), computed.get(type_id, zero)))
+
+        if repair and differences:
+            store.execute("DELETE FROM stock_counters")
+            store.execute("INSERT INTO stock_counters (type_id, %s) %s"
+                          % (", ".join(cls.COLUMNS), cls.SUMS))
+            store.commit()
+
+        return differences
+
 class Assignment(Storm):
     """Model for many to many relationship between Source and PartType"""
     __storm_table__ = "assignments"
@@ -347,6 +555,7 @@ class Assignment(Storm):
 
         :param part_pile: one Part object containing pile of parts to assign
         :type part_pile: instance of Part
+        :returns: the assigned pile or None when nothing was assigned
         """
 
         assert self.part_type == part_pile.part_type
@@ -364,6 +573,7 @@ class Assignment(Storm):
         # there are enough parts, assign them
         pile = part_pile.take(count)
         pile.assignment = self
+        return pile
 
 class TermTypeMapping(Storm):
     __storm_table__ = "terms_types"
@@ -373,6 +583,73 @@ class TermTypeMapping(Storm):
     type_id = Int()
     type = Reference(type_id, PartType.id)
 
+class IndexQueue(Storm):
+    """Model for part types waiting for search reindexing,
+       filled by triggers on the types table"""
+    __storm_table__ = "index_queue"
+
+    id = Int(primary=True)
+    type_id = Int()
+    queued = DateTime()
+
+class TermTrigram(Storm):
+    """Model for the n-gram index of search terms"""
+    __storm_table__ = "terms_trigrams"
+    __storm_primary__ = "trigram", "term_id"
+    trigram = Unicode()
+    term_id = Int()
+    term = Reference(term_id, "Term.id")
+
+class LRUCache(object):
+    """Mapping holding at most size recently used items.
+
+    Items live in two generations, the current one and the previous
+    one. Items found in the previous generation are moved to the
+    current one and when the current generation is full, it replaces
+    the previous one. The least recently used items are dropped that
+    way while lookups stay plain dict operations. Hits and misses of
+    get are counted."""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._current = {}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        try:
+            value = self._current[key]
+        except KeyError:
+            try:
+                value = self._previous[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.put(key, value)
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            if len(self._current) >= self.size / 2:
+                self._previous = self._current
+                self._current = {}
+            self._current[key] = value
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def clear(self):
+        with self._lock:
+            self._current = {}
+            self._previous = {}
+            self.hits = 0
+            self.misses = 0
+
 class Term(Storm):
     """Model for search term mapping."""
     __storm_table__ = "terms"
@@ -381,62 +658,78 @@ class Term(Storm):
     term = Unicode()
     alias_for_id = Int()
     alias_for = Reference(alias_for_id, "Term.id")
+    # end of the alias chain and the chain itself (/root id/.../id/),
+    # both maintained by database triggers
+    canonical_id = Int()
+    canonical = Reference(canonical_id, "Term.id")
+    alias_path = Unicode()
     part_types = ReferenceSet(id, TermTypeMapping.term_id, TermTypeMapping.type_id, PartType.id)
 
     @staticmethod
     def split(word):
         return word.split()
 
+    # simplified forms of the recently seen words
+    SIMPLIFIED = LRUCache(20000)
+    NON_ASCII = re.compile(u"[^\x00-\x7f]")
+
     @staticmethod
     def simplify(word):
         """Strips diacritics from unicode string"""
-        word = ''.join((c for c in unicodedata.normalize('NFD', word) if unicodedata.category(c) != 'Mn'))
-        return word.lower()
+        # nothing to strip from plain ascii
+        if Term.NON_ASCII.search(word) is None:
+            return word.lower()
 
-    @classmethod
-    def register(cls, part_type):
-        store = Store.of(part_type)
-        name = cls.split(part_type.name)
-        summary = cls.split(part_type.summary)
-        description = cls.split(part_type.description)
-        manufacturer = cls.split(part_type.manufacturer)
-        terms = []
-
-        # register the search terms
-        for word in name + summary + description + manufacturer:
-            word = cls.simplify(word)
-
-            term = store.find(Term, term=word).any()
-            if term is None:
-                term = Term()
-                term.term = word
-                store.add(term)
-            else:
-                while term.alias_for:
-                    term = term.alias_for
+        simple = Term.SIMPLIFIED.get(word)
+        if simple is None:
+            simple = ''.join((c for c in unicodedata.normalize('NFD', word) if unicodedata.category(c) != 'Mn'))
+            simple = simple.lower()
+            Term.SIMPLIFIED.put(word, simple)
 
-            if part_type not in term.part_types:
-                term.part_types.add(part_type)
+        return simple
 
-            terms.append(term)
-
-        terms = set(terms)
-
-        # remove stale search terms for updated object
-        # skip for new object
-        if part_type.id:
-            mappings = store.find(TermTypeMapping, type=part_type)
-            for mapping in mappings:
-                if mapping.term not in terms:
-                    store.remove(mapping)
+    @staticmethod
+    def matching(word, exact = False):
+        """Returns the condition selecting all terms which contain
+        the word (or are equal to it when exact is requested).
+
+        The n-gram index is used to narrow the candidates down, LIKE
+        is only evaluated for the indexed candidates. Every character
+        of a term starts one gram, the grams at the end of the term are
+        shorter than three characters so even one and two character
+        long substrings can be found using a prefix lookup."""
+        if exact:
+            return Term.term == word
+
+        like = Term.term.like(u"%%%s%%" % escape_like(word), "$")
+
+        if len(word) >= 3:
+            grams = set(word[i:i+3] for i in range(len(word) - 2))
+            candidates = Select(TermTrigram.term_id,
+                                TermTrigram.trigram.is_in(grams),
+                                group_by = TermTrigram.term_id,
+                                having = Count() == len(grams))
+        elif word:
+            # short words are prefixes of the grams starting at their position
+            candidates = Select(TermTrigram.term_id,
+                                And(TermTrigram.trigram >= word,
+                                    TermTrigram.trigram < word + u"\uffff"),
+                                distinct = True)
+        else:
+            return like
 
-        return terms
+        return And(Term.id.is_in(candidates), like)
 
     @staticmethod
-    def search(store, search_string):
-        results = set()
-        first_result = True
-        negate_list = []
+    def search_select(search_string):
+        """Returns the select of ids of all part types matching
+        the search string or None when there is no word to search for.
+
+        Words are matched as substrings of the search terms, words
+        enclosed in quotes have to match the whole term and words
+        starting with - exclude the part types they match."""
+        selects = []
+        negated = []
 
         for w in Term.split(search_string):
             if w.startswith("-"):
@@ -453,32 +746,423 @@ class Term(Storm):
 
             w = Term.simplify(w).lower()
 
-            if exact:
-                terms = store.find(Term, term=w)
-            else:
-                terms = store.find(Term, Term.term.like("%%%s%%" % w))
-
-            intermediate_result = set()
-            for term in terms:
-                intermediate_result.update(set(term.part_types))
-                while term.alias_for:
-                    term = term.alias_for
-                    intermediate_result.update(set(term.part_types))
-
-            if not negate:
-                if first_result:
-                    results = intermediate_result
-                    first_result = False
-                else:
-                    results.intersection_update(intermediate_result)
+            # search terms are mapped to the ends of their alias chains only
+            matched = Select(TermTypeMapping.type_id,
+                             TermTypeMapping.term_id.is_in(Select(Term.canonical_id,
+                                                                  Term.matching(w, exact))))
+            if negate:
+                negated.append(matched)
             else:
-                negate_list.append(intermediate_result)
+                selects.append(matched)
+
+        if not selects:
+            return None
 
-        for neg in negate_list:
-            results.difference_update(neg)
+        if negated:
+            selects.append(Select(PartType.id, Not(PartType.id.is_in(union(negated)))))
 
+        return intersection(selects)
+
+    @staticmethod
+    def search_ids(store, search_string):
+        """Returns ids of all part types matching the search string,
+           see search_select."""
+        select = Term.search_select(search_string)
+        if select is None:
+            return set()
+
+        return set(row[0] for row in store.execute(select))
+
+    @staticmethod
+    def search(store, search_string):
+        ids = Term.search_ids(store, search_string)
+        results = set()
+        for chunk in chunks(list(ids)):
+            results.update(store.find(PartType, PartType.id.is_in(chunk)))
         return results
 
+class TermSearch(object):
+    """Search backend using the terms tables maintained by the indexer.
+       It is always available, but does not rank the results."""
+
+    @classmethod
+    def setup(cls, store):
+        return True
+
+    def search(self, store, search_string):
+        """Returns list of matching part type ids, best matches first"""
+        return sorted(Term.search_ids(store, search_string))
+
+    def narrowing(self, previous, search_string):
+        """Returns the words the part types matching the previous search
+           string have to contain to match search_string too or None
+           when its results can't be computed from the previous ones."""
+        if not previous or not search_string.startswith(previous):
+            return None
+
+        old = Term.split(previous)
+        new = Term.split(search_string)
+        if not old or new[:len(old) - 1] != old[:-1]:
+            return None
+
+        # without a plain word the previous string searched for nothing,
+        # its empty result is not a superset of the new one
+        if all(w.startswith(u"-") or w.startswith(u"\"") for w in old):
+            return None
+
+        # the last word might get longer and new words can be added
+        changed = new[len(old):]
+        if new[len(old) - 1] != old[-1]:
+            changed.insert(0, new[len(old) - 1])
+
+        words = []
+        for w in changed:
+            # exact and excluding words do not narrow the substring match
+            if w.startswith(u"-") or w.startswith(u"\""):
+                return None
+            words.append(Term.simplify(w).lower())
+
+        return words
+
+    def words(self, store, ids):
+        """Returns dict mapping the part type ids to the sets of terms
+           matching them, including all the aliases of their terms"""
+        words = {}
+        for chunk in chunks(list(ids)):
+            result = store.execute("SELECT terms_types.type_id, terms.term FROM terms_types"
+                                   " JOIN terms ON terms.canonical_id = terms_types.term_id"
+                                   " WHERE terms_types.type_id IN (%s)" % ", ".join("?" * len(chunk)),
+                                   chunk)
+            for type_id, term in result:
+                words.setdefault(type_id, set()).add(term)
+        return words
+
+class FTSSearch(TermSearch):
+    """Search backend ranking the part types matched by the terms
+       using SQLite FTS5 virtual table. All texts are folded using
+       Term.simplify before they are indexed and the matches are
+       ordered by bm25.
+
+       Part types matched only through a substring in the middle of
+       a word or through an alias of the searched word follow the
+       ranked ones."""
+
+    TABLE = u"types_fts"
+    COLUMNS = ("name", "summary", "description", "manufacturer")
+    WEIGHTS = (10.0, 4.0, 1.0, 2.0)
+
+    @classmethod
+    def setup(cls, store):
+        """Creates the FTS table if needed, returns False when
+           FTS5 is not available in this SQLite library"""
+        exists = store.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                               (cls.TABLE, )).get_one()
+        if exists:
+            return True
+
+        try:
+            store.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, tokenize = 'unicode61 remove_diacritics 0')"
+                          % (cls.TABLE, ", ".join(cls.COLUMNS)))
+        except OperationalError:
+            return False
+
+        backend = cls()
+        for part_type in store.find(PartType):
+            backend.index_text(store, part_type)
+        store.commit()
+
+        return True
+
+    @staticmethod
+    def fold(text):
+        return u" ".join(Term.simplify(w) for w in Term.split(text or u""))
+
+    def index_text(self, store, part_type):
+        values = [self.fold(getattr(part_type, c)) for c in self.COLUMNS]
+        store.execute("INSERT OR REPLACE INTO %s (rowid, %s) VALUES (?, %s)"
+                      % (self.TABLE, ", ".join(self.COLUMNS),
+                         ", ".join("?" * len(self.COLUMNS))),
+                      [part_type.id] + values)
+
+    @staticmethod
+    def query(search_string):
+        """Converts the positive words of search string to FTS5 query
+           matching any of their prefixes, returns None when there
+           is no such word"""
+        words = []
+
+        for w in Term.split(search_string):
+            if w.startswith("-"):
+                continue
+
+            if w.startswith("\"") and w.endswith("\"") and len(w) > 1:
+                w = w[1:-1]
+                suffix = u""
+            else:
+                suffix = u"*"
+
+            w = Term.simplify(w)
+            if not w:
+                continue
+
+            words.append(u'"%s"%s' % (w.replace(u'"', u'""'), suffix))
+
+        if not words:
+            return None
+
+        return u" OR ".join(words)
+
+    def search(self, store, search_string):
+        ids = Term.search_ids(store, search_string)
+        if not ids:
+            return []
+
+        ranked = []
+        query = self.query(search_string)
+        if query is not None:
+            result = store.execute("SELECT rowid FROM %s WHERE %s MATCH ? ORDER BY bm25(%s, %s)"
+                                   % (self.TABLE, self.TABLE, self.TABLE,
+                                      ", ".join("%f" % w for w in self.WEIGHTS)),
+                                   (query, ))
+            ranked = [row[0] for row in result if row[0] in ids]
+
+        # the deleted part types might still wait in the index queue,
+        # their stale rows are skipped as they are not matched by the terms
+        ranked.extend(sorted(ids.difference(ranked)))
+        return ranked
+
+class SearchCache(object):
+    """Results of the recently typed search strings.
+
+    Typing a word longer or adding another one matches a subset of the
+    previous results, so they are filtered in memory using the terms
+    of the matched part types when the backend allows it. Going
+    back to a shorter search string reuses its cached results."""
+
+    SIZE = 64
+    # words of bigger results are not loaded, they are searched again
+    NARROW_LIMIT = 2000
+
+    def __init__(self):
+        # search string -> (ranked ids, their words or None)
+        self._results = LRUCache(self.SIZE)
+        self.narrowed = 0
+
+    def clear(self):
+        self._results.clear()
+
+    def search(self, store, search_string):
+        """Returns the list of part type ids matching search string,
+           best matches first"""
+        cached = self._results.get(search_string)
+        if cached is not None:
+            return list(cached[0])
+
+        backend = search_backend(store)
+
+        # the longest cached prefix has the fewest results to narrow
+        for end in range(len(search_string) - 1, 0, -1):
+            previous = self._results.get(search_string[:end])
+            if previous is None:
+                continue
+
+            required = backend.narrowing(search_string[:end], search_string)
+            if required is None or previous[1] is None:
+                break
+
+            ids, words = previous
+            ids = [i for i in ids
+                   if all(any(r in w for w in words.get(i, ())) for r in required)]
+            self._results.put(search_string, (ids, dict((i, words[i]) for i in ids if i in words)))
+            self.narrowed += 1
+            return list(ids)
+
+        ids = backend.search(store, search_string)
+        words = None
+        if len(ids) <= self.NARROW_LIMIT:
+            words = backend.words(store, ids)
+        self._results.put(search_string, (ids, words))
+        return list(ids)
+
+# backends in the order of preference, the first one
+# which is available in the database gets used
+SEARCH_BACKENDS = [FTSSearch, TermSearch]
+
+_search_backends = weakref.WeakKeyDictionary()
+
+def search_backend(store):
+    """Returns the search backend used for store"""
+    backend = _search_backends.get(store)
+    if backend is None:
+        for cls in SEARCH_BACKENDS:
+            if cls.setup(store):
+                backend = _search_backends[store] = cls()
+                break
+
+    return backend
+
+class FuzzyMatcher(object):
+    """Typo tolerant matcher of part type names.
+
+    Names are reduced to lower case letters and digits only (so
+    "ATmega328P" and "ATMEGA 328-P" are equal) and compared using
+    the Dice coefficient of their trigram sets. The trigram index
+    is kept in memory and rebuilt when the types table changes."""
+
+    def __init__(self):
+        self._signature = None
+        self._grams = {}
+        self._types = {}
+
+    @staticmethod
+    def normalize(name):
+        return u"".join(c for c in Term.simplify(name or u"") if c.isalnum())
+
+    @staticmethod
+    def trigrams(name):
+        """Returns the trigram set of normalized name, the word
+           boundaries are padded so short names get grams too"""
+        name = u"  %s " % name
+        return frozenset(name[i:i+3] for i in range(len(name) - 2))
+
+    @staticmethod
+    def signature(store):
+        return store.execute("SELECT count(*), max(id), max(changed) FROM types").get_one()
+
+    def refresh(self, store):
+        """Rebuilds the trigram index if the part types changed"""
+        signature = self.signature(store)
+        if signature == self._signature:
+            return
+
+        self._grams = {}
+        self._types = {}
+        for type_id, name in store.find(PartType).values(PartType.id, PartType.name):
+            grams = self._types[type_id] = self.trigrams(self.normalize(name))
+            for gram in grams:
+                self._grams.setdefault(gram, []).append(type_id)
+
+        self._signature = signature
+
+    def match(self, name, limit = 5, threshold = 0.4, candidates = None):
+        """Returns up to limit (type id, score) pairs of part types with
+           names similar to name, best matches first. The score is
+           between threshold and 1.0, candidates optionally restrict
+           the part types considered."""
+        grams = self.trigrams(self.normalize(name))
+        if not grams:
+            return []
+
+        # score >= threshold needs at least minimum common grams, so
+        # every match contains one of the rarest len - minimum + 1 grams
+        # and only the part types listed for them have to be compared
+        minimum = int(math.ceil(threshold * len(grams) / (2.0 - threshold)))
+        rarest = sorted(grams, key = lambda g: len(self._grams.get(g, ())))
+        found = set()
+        for gram in rarest[:len(grams) - max(minimum, 1) + 1]:
+            found.update(self._grams.get(gram, ()))
+
+        if candidates is not None:
+            found.intersection_update(candidates)
+
+        scores = []
+        for type_id in found:
+            type_grams = self._types[type_id]
+            score = 2.0 * len(grams & type_grams) / (len(grams) + len(type_grams))
+            if score >= threshold:
+                scores.append((score, type_id))
+
+        scores.sort(reverse = True)
+        return [(type_id, s) for s, type_id in scores[:limit]]
+
+_fuzzy_matchers = weakref.WeakKeyDictionary()
+
+def fuzzy_matcher(store):
+    """Returns the up to date fuzzy matcher for store"""
+    matcher = _fuzzy_matchers.get(store)
+    if matcher is None:
+        matcher = _fuzzy_matchers[store] = FuzzyMatcher()
+
+    matcher.refresh(store)
+    return matcher
+
+def escape_like(value, escape = u"$"):
+    """Escapes LIKE wildcards in value so it can be used in a pattern"""
+    for c in (escape, u"%", u"_"):
+        value = value.replace(c, escape + c)
+    return value
+
+def chunks(seq, size = 500):
+    """Splits seq to lists of at most size items to keep the number
+    of SQL variables in IN (...) conditions under SQLite limits."""
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+def insert_many(store, sql, rows, batch = 200):
+    """Executes INSERT statement sql (ending with VALUES) for all rows
+       using one multi-row statement per batch."""
+    for chunk in chunks(rows, batch):
+        row = u"(%s)" % u", ".join(u"?" * len(chunk[0]))
+        store.execute(sql + u", ".join([row] * len(chunk)),
+                      [value for values in chunk for value in values])
+
+def select_many(store, sql, rows, batch = 200):
+    """Executes SELECT statement sql for all rows and yields the results.
+       The rows are passed as VALUES list replacing the %s placeholder
+       in sql, one statement is used per batch of rows."""
+    for chunk in chunks(rows, batch):
+        row = u"(%s)" % u", ".join(u"?" * len(chunk[0]))
+        for result in store.execute(sql % u", ".join([row] * len(chunk)),
+                                    [value for values in chunk for value in values]):
+            yield result
+
+def intersection(selects):
+    """Returns the select of rows returned by all selects"""
+    if len(selects) == 1:
+        return selects[0]
+    return Intersect(*selects)
+
+def union(selects):
+    """Returns the select of rows returned by any of selects"""
+    if len(selects) == 1:
+        return selects[0]
+    return Union(*selects)
+
+class SearchResult(Storm):
+    """Model for ranked search results stored in a temporary table,
+       the browsers join it instead of listing all the ids in SQL"""
+    __storm_table__ = "search_results"
+    __storm_primary__ = "search", "type_id"
+
+    search = Int()
+    type_id = Int()
+    rank = Int()
+
+    _keys = itertools.count(1)
+
+    @classmethod
+    def key(cls, store):
+        """Returns a new key identifying ranked part type ids
+           in search_results table"""
+        store.execute("CREATE TEMP TABLE IF NOT EXISTS search_results ("
+                      "search integer not null, type_id integer not null, "
+                      "rank integer not null, PRIMARY KEY (search, type_id))")
+        return cls._keys.next()
+
+    @classmethod
+    def save(cls, store, ids, key = None):
+        """Stores the ranked part type ids under key (a new one by default)
+           and returns the key identifying them in search_results table"""
+        if key is None:
+            key = cls.key(store)
+        insert_many(store, u"INSERT OR IGNORE INTO search_results (search, type_id, rank) VALUES ",
+                    [(key, type_id, rank) for rank, type_id in enumerate(ids)])
+        return key
+
+    @classmethod
+    def drop(cls, store, key):
+        store.execute("DELETE FROM search_results WHERE search = ?", (key, ))
+
 class Struct:
     def __init__(self, **entries):
         self.__dict__.update(entries)
@@ -501,7 +1185,8 @@ class RawPart(Struct):
             "vat": None,
             "source": None,
             "datasheet": u"",
-            "matches": []
+            "matches": [],
+            "scores": {}
             }
 
         if extra:
@@ -531,11 +1216,16 @@ class Meta(Storm):
 class ForeignKeysSQLite(SQLite):
     """Set SQLite foreign key integrity mode. Has to be set
        on raw connection as storm.Store does too much magic with
-       transactions"""
+       transactions.
+
+       WAL journal is used so the background indexer can write
+       while the UI connection keeps its read transaction open."""
 
     def raw_connect(self):
         connection = SQLite.raw_connect(self)
         connection.execute("PRAGMA foreign_keys = ON;")
+        if self._filename != ":memory:":
+            connection.execute("PRAGMA journal_mode = WAL;")
         return connection
 
 def getStore(url, create = False):
@@ -546,8 +1236,7 @@ def getStore(url, create = False):
     s = Store(d)
 
     if create:
-        schema = file(os.path.join(os.path.dirname(__file__), "schema.sql"), "r").read().split("\n\n")
-        for cmd in schema:
+        for cmd in sqlScript("schema.sql"):
             s.execute(cmd)
 
         version = Meta()
@@ -555,80 +1244,133 @@ def getStore(url, create = False):
         s.add(version)
 
         s.commit()
+    else:
+        upgradeSchema(s)
+
+    # prepare search indexes
+    search_backend(s)
 
     return s
 
+def sqlScript(name):
+    """Returns the list of SQL commands stored in the named file,
+       commands are separated by empty lines."""
+    return file(os.path.join(os.path.dirname(__file__), name), "r").read().split("\n\n")
+
+def upgradeSchema(store):
+    """Runs all upgrade-<version>.sql scripts needed to bring
+       the database schema to the current version. Every script
+       has to update the version stored in meta table."""
+    while True:
+        version = store.get(Meta, u"version").value
+        name = "upgrade-%s.sql" % version
+        if not os.path.exists(os.path.join(os.path.dirname(__file__), name)):
+            break
+
+        for cmd in sqlScript(name):
+            store.execute(cmd)
+
+        store.invalidate()
+        store.commit()
+
 
 def fill_matches(store, data):
-    search_name = data.search_name
-    sku = data.sku
-    manufacturer = data.manufacturer
-    footprint = data.footprint
-    source = data.source
-
-    parts = []
-    #if search_name:
-    #    name_parts = search_name.split()
-    #    for name_part in name_parts:
-    #        parts.append(list(store.find(PartType, Or(
-    #                        PartType.name.like("%%%s%%" % name_part, "$", False),
-    #                        PartType.summary.like("%%%s%%" % name_part, "$", False),
-    #                        PartType.description.like("%%%s%%" % name_part, "$", False)))
-    #                     .config(distinct = True)
-    #                     .values(PartType.id)))
-
-    if search_name:
-        parts.append([part_type.id for part_type in Term.search(store, search_name)])
-
-    if sku:
-        args = [ PartSource.sku.like("%s%%" % sku, "$", False) ]
-        if source is not None:
-            args.append(PartSource.source == source)
-
-        # do not filter by source unless we are also checking for sku
-        result = list(store.find(PartSource, *args)
-                           .config(distinct = True)
-                           .values(PartSource.part_type_id))
+    return fill_matches_many(store, [data])[0]
 
-        # do not filter by sku if no such vendor/sku was found - we might be shopping somewhere else now
-        if result:
-            parts.append(result)
-
-    if manufacturer:
-        parts.append(list(store.find(PartType, Or(PartType.manufacturer == u"",
-                                                  PartType.manufacturer.like("%%%s%%" % manufacturer, "$", False)))
-                     .config(distinct = True)
-                     .values(PartType.id)))
-
-    if footprint:
-        parts.append(list(store.find((PartType, Footprint),
-                                Footprint.name.like("%%%s%%" % footprint, "$", False),
-                                PartType.footprint_id == Footprint.id)
-                     .config(distinct = True)
-                     .values(PartType.id)))
+def _match_conditions(data, skus):
+    """Returns the list of conditions on part types matching
+       RawPart data other than by name. Skus is the set of the
+       (sku pattern, source id) pairs which exist."""
+    conditions = []
 
-    if hasattr(data, "item"):
-        parts.append(list(
-            store.find(Assignment, Assignment.item == data.item)
-            .config(distinct = True).values(Assignment.part_type_id)))
+    if data.sku:
+        sku = (u"%s%%" % data.sku, data.source and data.source.id)
 
-    if hasattr(data, "project"):
-        parts.append(list(
-            store.find((Assignment, Item), Assignment.item == Item.id, Item.project == data.project)
-            .config(distinct = True).values(Assignment.part_type_id)))
+        # do not filter by sku if no such vendor/sku was found - we might be shopping somewhere else now
+        if sku in skus:
+            args = [ PartSource.sku.like(sku[0], "$", False) ]
 
-    # create a set containing all part types which matched all queries
-    if parts:
-        res = set(parts[0])
-    else:
-        res = set()
+            # do not filter by source unless we are also checking for sku
+            if sku[1] is not None:
+                args.append(PartSource.source_id == sku[1])
+            conditions.append(PartType.id.is_in(Select(PartSource.part_type_id, And(*args))))
 
-    for p in parts[1:]:
-        res = res.intersection(set(p))
+    if data.manufacturer:
+        conditions.append(Or(PartType.manufacturer == u"",
+                             PartType.manufacturer.like(u"%%%s%%" % data.manufacturer, "$", False)))
 
-    data.matches = res
+    if data.footprint:
+        conditions.append(PartType.footprint_id.is_in(
+            Select(Footprint.id, Footprint.name.like(u"%%%s%%" % data.footprint, "$", False))))
 
-    return data
+    if hasattr(data, "item"):
+        conditions.append(PartType.id.is_in(
+            Select(Assignment.part_type_id, Assignment.item_id == data.item.id)))
+
+    if hasattr(data, "project"):
+        conditions.append(PartType.id.is_in(
+            Select(Assignment.part_type_id, And(Assignment.item_id == Item.id,
+                                                Item.project_id == data.project.id))))
+
+    return conditions
+
+def _select_many(store, selects):
+    """Runs the dict of selects of part type ids and returns dict
+       with sets of the selected ids"""
+    return dict((key, set(row[0] for row in store.execute(select)))
+                for key, select in selects.iteritems())
+
+def fill_matches_many(store, parts):
+    """Fills matches (and scores of fuzzy matches) of all RawParts
+       in parts. The part types matching all the criteria of a part
+       are selected by a single SQL query returning just their ids,
+       the existing vendor skus are looked up for all parts at once."""
+    # the vendor skus which exist, parts with unknown sku are not filtered by it
+    skus = set((u"%s%%" % data.sku, data.source and data.source.id)
+               for data in parts if data.sku)
+    skus = set(select_many(store, u"WITH v(pattern, source) AS (VALUES %s) "
+                           u"SELECT pattern, source FROM v WHERE EXISTS "
+                           u"(SELECT 1 FROM types_sources WHERE types_sources.sku LIKE v.pattern ESCAPE '$' "
+                           u"AND (v.source IS NULL OR types_sources.source_id = v.source))",
+                           list(skus)))
+
+    selects = {}
+    others = {}
+    for key, data in enumerate(parts):
+        others[key] = _match_conditions(data, skus)
+        criteria = list(others[key])
+
+        if data.search_name:
+            name = Term.search_select(data.search_name)
+            if name is None:
+                # no word to search for, nothing can match
+                continue
+            criteria.insert(0, PartType.id.is_in(name))
+
+        if criteria:
+            selects[key] = Select(PartType.id, And(*criteria))
+
+    matches = _select_many(store, selects)
+
+    # nothing found, the name might contain a typo - offer the part
+    # types with similar names satisfying the other conditions
+    fuzzy = [key for key, data in enumerate(parts)
+             if data.search_name and not matches.get(key)]
+    if fuzzy:
+        matcher = fuzzy_matcher(store)
+        candidates = _select_many(store, dict((key, Select(PartType.id, And(*others[key])))
+                                              for key in fuzzy if others[key]))
+
+    for key, data in enumerate(parts):
+        data.scores = {}
+        data.matches = matches.get(key, set())
+
+        if key in fuzzy:
+            data.scores = dict(matcher.match(data.search_name,
+                                             candidates = candidates.get(key)))
+            data.matches = set(data.scores)
+
+    return parts
 
 def debug(stream):
     import storm.tracer
@@ -3,6 +3,7 @@
 import urwid
 import app
 import model
+from storm.expr import LeftJoin
 from app import Edit, FloatEdit, IntEdit, CheckBox, Button
 
 
@@ -63,8 +64,7 @@ class PartCreator(app.UIScreen):
         new_part_type.manufacturer = part.manufacturer
         store.add(new_part_type)
 
-        # update records in search term table
-        model.Term.register(new_part_type)
+        # search indexes are updated by the background indexer
 
         return new_part_type
 
@@ -117,14 +117,60 @@ class PartCreator(app.UIScreen):
             raise
 
 
+class Candidate(urwid.WidgetWrap):
+    """One line summary of a part type matching the selected part,
+    the details created by the details function are shown instead
+    of it while it has the focus."""
+
+    def __init__(self, store, type_id, summary, details):
+        urwid.WidgetWrap.__init__(self, summary)
+        self._store = store
+        self._details = details
+        self._expanded = None
+        self.type_id = type_id
+
+    @property
+    def _data(self):
+        return self._store.get(model.PartType, self.type_id)
+
+    @property
+    def details(self):
+        if self._expanded is None:
+            self._expanded = self._details()
+        return self._expanded
+
+    def _current(self, focus):
+        if focus:
+            return self.details
+        return self._w
+
+    def selectable(self):
+        return True
+
+    def keypress(self, size, key):
+        return key
+
+    def rows(self, size, focus = False):
+        return self._current(focus).rows(size, focus)
+
+    def render(self, size, focus = False):
+        return self._current(focus).render(size, focus)
+
+
 class PartSelector(app.UIScreen):
     def __init__(self, a, store, partlist, action, action_kwargs={},
                  back=None, create_new=True):
         app.UIScreen.__init__(self, a, store, back)
-        self._partlist = [model.fill_matches(self.store, w) for w in partlist]
+        self._partlist = list(partlist)
+        self._matched = False
+        self._matching = None
         self._save = app.SaveRegistry()
         self._spacer = urwid.Divider(u" ")
         self._current = 0
+        # candidate widgets of the parts and the summaries of part types
+        self._candidates = {}
+        self._summaries = {}
+        self._prefetching = None
         self._create_new = create_new
         self._action = action
         self._action_kwargs = action_kwargs
@@ -138,20 +184,140 @@ class PartSelector(app.UIScreen):
         self._a = lambda w: urwid.AttrWrap(w, "edit")
         self._c = lambda w: urwid.AttrWrap(w, "edit_c")
 
-    def _match_entry(self, selected_part_type, p_id):
+    def _detached(self):
+        """Returns copies of the parts the query executor can match,
+           the objects they reference are replaced by their ids"""
+        parts = []
+        for p in self._partlist:
+            copy = model.RawPart(p.__dict__)
+            copy.part_type = None
+            for name in ("source", "item", "project"):
+                obj = getattr(copy, name, None)
+                if obj is not None:
+                    setattr(copy, name, model.Struct(id = obj.id))
+            parts.append(copy)
+        return parts
+
+    @staticmethod
+    def match(store, parts):
+        """Returns the matches and scores of parts, runs in the query executor"""
+        return [(p.matches, p.scores) for p in model.fill_matches_many(store, parts)]
+
+    def matched(self, result):
+        for p, (matches, scores) in zip(self._partlist, result):
+            p.matches = matches
+            p.scores = scores
+        self._matched = True
+        self._candidates.clear()
+
+        # the loading screen is shown, show the current part
+        if self._matching:
+            self._matching = None
+            self.app.switch_screen(self, self._current)
+
+    @staticmethod
+    def summaries(store, type_ids):
+        """Returns dict mapping the part type ids to tuples (name, footprint,
+           manufacturer, summary, free count), runs in the query executor"""
+        summaries = {}
+        tables = [model.PartType,
+                  LeftJoin(model.Footprint, model.Footprint.id == model.PartType.footprint_id),
+                  LeftJoin(model.StockCounter, model.StockCounter.type_id == model.PartType.id)]
+        for chunk in model.chunks(list(type_ids)):
+            rows = store.using(*tables).find((model.PartType.id, model.PartType.name,
+                                              model.Footprint.name, model.PartType.manufacturer,
+                                              model.PartType.summary, model.StockCounter.free),
+                                             model.PartType.id.is_in(chunk))
+            for row in rows:
+                summaries[row[0]] = row[1:]
+        return summaries
+
+    def _summary(self, p_id, score = None):
+        name, footprint, manufacturer, summary, free = self._summaries[p_id]
+        columns = [
+            ("weight", 2, urwid.Text(name)),
+            ("fixed", 10, urwid.Text(footprint or u"")),
+            ("weight", 1, urwid.Text(manufacturer or u"")),
+            ("weight", 3, urwid.Text(summary or u"")),
+            ("fixed", 6, urwid.Text(unicode(free or 0), align = "right"))
+            ]
+        if score is not None:
+            columns.append(("fixed", 5, urwid.Text(u"%d%%" % (100 * score), align = "right")))
+        return urwid.AttrWrap(urwid.Columns(columns, 1), "part")
+
+    def _candidates_of(self, part):
+        """Returns the candidate widgets of part, they are created
+           once and reused when the part is shown again"""
+        candidates = self._candidates.get(part)
+        if candidates is not None:
+            return candidates
+
+        # the most similar fuzzy matches go first
+        matches = sorted(part.matches, key = lambda p: -part.scores.get(p, 1.0))
+        missing = [p_id for p_id in matches if p_id not in self._summaries]
+        if missing:
+            self._summaries.update(self.summaries(self.store, missing))
+
+        # the details are loaded only for the focused candidates
+        def details(p_id, score):
+            return lambda: self._h(self._match_entry(None, p_id, score))
+
+        candidates = self._candidates[part] = [
+            Candidate(self.store, p_id, self._summary(p_id, part.scores.get(p_id)),
+                      details(p_id, part.scores.get(p_id)))
+            for p_id in matches if p_id in self._summaries]
+        return candidates
+
+    def prefetch(self, index):
+        """Loads the summaries of candidates of the part at index
+           in background"""
+        if index >= len(self._partlist):
+            return
+
+        missing = [p_id for p_id in self._partlist[index].matches
+                   if p_id not in self._summaries]
+        if missing:
+            self._prefetching = self.query(self.summaries, self._summaries.update, missing)
+
+    def _load_sources(self, type_ids):
+        """Returns dict mapping the part type ids to their sources and
+           dict with the current price tiers of all those sources"""
+        part_sources = dict((type_id, []) for type_id in type_ids)
+        for chunk in model.chunks(list(type_ids)):
+            for s in self.store.find(model.PartSource, model.PartSource.part_type_id.is_in(chunk)):
+                part_sources[s.part_type_id].append(s)
+
+        loaded = sum(part_sources.values(), [])
+        # the store cache keeps the vendors for the s.source references
+        source_ids = list(set(s.source_id for s in loaded))
+        list(self.store.find(model.Source, model.Source.id.is_in(source_ids)))
+        return part_sources, model.PartSource.current_prices(self.store, loaded)
+
+    def _match_entry(self, selected_part_type, p_id, score = None,
+                     part_sources = None, tiers = None):
         p = self.store.get(model.PartType, p_id)
+        if part_sources is None:
+            part_sources, tiers = self._load_sources([p_id])
 
         sources = [urwid.Text(_(u"Sources"))]
 
-        for s in p.sources:
+        for s in part_sources[p_id]:
+            current = tiers.get(s.price_id)
             sources.append(urwid.Columns([
                 ("fixed", len(s.source.name), urwid.Text(s.source.name)),
                 ("fixed", 1, urwid.Text(u"/")),
                 urwid.Text(s.sku),
-                urwid.Text(unicode(s.price)),
+                urwid.Text(unicode(current[0].price if current else 0.0)),
                 ], 3))
 
-        header = urwid.AttrWrap(urwid.Text(p.name), "part")
+        if score is None:
+            header = urwid.AttrWrap(urwid.Text(p.name), "part")
+        else:
+            # fuzzy match, show how similar the name is
+            header = urwid.AttrWrap(urwid.Columns([
+                urwid.Text(p.name),
+                ("fixed", 16, urwid.Text(_(u"similarity %d%%") % (100 * score), align = "right"))
+                ], 1), "part")
         line2 = urwid.Columns([
             ("fixed", 10, urwid.Text(_(u"summary"))),
             self._c(urwid.Text(p.summary)),
@@ -237,6 +403,7 @@ class PartSelector(app.UIScreen):
             self._spacer
             ])
         pile._data = None
+        pile.type_id = None
         return pile
 
     def _notfound(self, p):
@@ -292,12 +459,18 @@ class PartSelector(app.UIScreen):
 
         self._current = args
 
+        if not self._matched:
+            self._matching = self.query(self.match, self.matched, self._detached())
+            if not self._matched:
+                self.walker = urwid.SimpleListWalker([urwid.Text(_(u"Looking for matching part types..."))])
+                self.body = urwid.ListBox(self.walker)
+                return self.body
+
         self._save.clear()
         part = self._partlist[args]
         listbox_content = []
 
-        existing_parts = [self._match_entry(part.part_type, p)
-                          for p in part.matches]
+        existing_parts = list(self._candidates_of(part))
         if self._create_new:
             # fill number of pins based on previous input (either from footprint
             # db or from different part with the same footprint)
@@ -324,12 +497,16 @@ class PartSelector(app.UIScreen):
             part.part_type = existing_parts[0]._data
 
         #sort the content so the selected part is on top
-        head_part = filter(lambda p: p._data == part.part_type, existing_parts)
+        selected = part.part_type and part.part_type.id
+        head_part = filter(lambda p: p.type_id == selected, existing_parts)
         if head_part:
+            head = head_part[0]
+            if isinstance(head, Candidate):
+                head = head.details
             pile = self._h(urwid.Pile(
                 self.header(part) +
                 [
-                head_part[0]
+                head
                 ]))
             pile._data = head_part[0]._data
             listbox_content.append(pile)
@@ -359,15 +536,21 @@ class PartSelector(app.UIScreen):
 
         if len(existing_parts) > 1:
             def _hdata(p):
+                # candidates highlight their details themselves
+                if isinstance(p, Candidate):
+                    return p
                 h = self._h(p)
                 h._data = p._data
                 return h
             listbox_content.extend([self._spacer, urwid.Text(_(u"Other possible part types:")), urwid.Divider(u"="), self._spacer])
-            listbox_content.extend([_hdata(p) for p in existing_parts if p._data != part.part_type])
+            listbox_content.extend([_hdata(p) for p in existing_parts if p.type_id != selected])
 
         self.walker = urwid.SimpleListWalker(listbox_content)
         self.body = urwid.ListBox(self.walker)
 
+        # the user reviews this part now, get the next one ready
+        self.prefetch(args + 1)
+
         return self.body
 
     def next(self, signal, args=None):
@@ -399,7 +582,7 @@ class PartSelector(app.UIScreen):
         self.app.switch_screen(self, self._current)
 
     def input(self, key):
-        if key == "enter":
+        if key == "enter" and self._matched:
             for w in self._save:
                 w.save()
 
@@ -3,7 +3,8 @@
 import app
 import urwid
 import model
-from generics import GenericSelector, GenericEditor
+from storm.expr import Sum, Count
+from generics import GenericSelector, GenericEditor, Changed
 from part_selector import SearchForParts, PartCreator
 from browser import PartBrowser
 from app import Edit, IntEdit, CheckBox, Button
@@ -25,17 +26,19 @@ class AssignmentPartSelector(PartBrowser):
             amdlg = AmountDialog(self.app, _(u"%s [%s]") % (pile.part_type.name, pile.part_type.footprint.name),
                                  _(u"How many parts were %s [max %d] ?" % (msg, pile.count)),
                                  pile.count)
+            self.run_dialog(amdlg, self.solder_pile, pile, solder, amdlg)
+        else:
+            return self.solder_pile(pile, solder)
 
-            if self.app.run_dialog(amdlg):
-                pile = pile.take(amdlg.value)
-                self.store.add(pile)
-            else:
-                pile = None
+    def solder_pile(self, pile, solder, amdlg = None):
+        original = pile
+        if amdlg:
+            pile = pile.take(amdlg.value)
+            self.store.add(pile)
 
-        if pile:
-            pile.soldered = solder
-            self.store.commit()
-            return self.REFRESH
+        pile.soldered = solder
+        self.store.commit()
+        return Changed(original, pile)
 
     def solder(self, widget, id):
         return self.do_solder(widget._data, _(u"soldered"), solder = True)
@@ -47,14 +50,15 @@ class AssignmentPartSelector(PartBrowser):
         amdlg = AmountDialog(self.app, _(u"%s [%s]") % (widget._data.part_type.name, widget._data.part_type.footprint.name),
                              _(u"How many parts were destroyed [max %d] ?" % widget._data.count),
                              0)
+        self.run_dialog(amdlg, self.kill_pile, widget._data, amdlg)
 
-        if self.app.run_dialog(amdlg):
-            pile = widget._data.take(amdlg.value)
-            pile.assignment = None
-            pile.usable = False
-            self.store.add(pile)
-            self.store.commit()
-            return self.REFRESH
+    def kill_pile(self, original, amdlg):
+        pile = original.take(amdlg.value)
+        pile.assignment = None
+        pile.usable = False
+        self.store.add(pile)
+        self.store.commit()
+        return Changed(original, pile)
 
     # enter should allow changing the amount and we need to remap the history screen
     history = PartBrowser.select
@@ -68,23 +72,25 @@ class AssignmentPartSelector(PartBrowser):
         amdlg = AmountDialog(self.app, _(u"%s [%s]") % (widget._data.part_type.name, widget._data.part_type.footprint.name),
                              _(u"Maximum number of parts to take from this pile [max %d] ?" % widget._data.count),
                              widget._data.count)
+        self.run_dialog(amdlg, self.select_pile, widget._data, used, amdlg)
 
-        if not self.app.run_dialog(amdlg):
-            return
+    def select_pile(self, original, used, amdlg):
+        changed = Changed(original)
 
         # unused pile, take parts from it
         if used == 0 and amdlg.value > 0:
-            self._assignment.assign(widget._data, maximum = amdlg.value)
+            changed.append(self._assignment.assign(original, maximum = amdlg.value))
             self.store.commit()
 
         # used pile, remove parts from it
         elif used > 0 and amdlg.value < used:
-            pile = widget._data.take(used - amdlg.value)
+            pile = original.take(used - amdlg.value)
             pile.assignment = None
             self.store.add(pile)
             self.store.commit()
+            changed.append(pile)
 
-        return self.REFRESH
+        return changed
 
 
 class ItemAssigner(app.UIScreen):
@@ -154,6 +160,10 @@ class AssignmentSelector(GenericSelector):
         (_(u"cnt"), "fixed", 3, "count_assigned"),
         (_(u"sld"), "fixed", 3, "count_soldered"),
         ]
+    AGGREGATES = {
+        "count_assigned": (model.Part.assignment_id, Sum(model.Part.count)),
+        "count_soldered": (model.Part.assignment_id, Sum(model.Part.count * model.Part.soldered))
+        }
 
     def __init__(self, a, store, item):
         GenericSelector.__init__(self, a, store)
@@ -179,12 +189,13 @@ class AssignmentSelector(GenericSelector):
 
     def edit(self, widget, id):
         self._amdlg.value = widget._data.count
-        if not self.app.run_dialog(self._amdlg):
-            return
-        if widget._data.count != self._amdlg.value:
-            widget._data.count = self._amdlg.value
+        self.run_dialog(self._amdlg, self.set_count, widget._data)
+
+    def set_count(self, assignment):
+        if assignment.count != self._amdlg.value:
+            assignment.count = self._amdlg.value
             self.store.commit()
-        return self.REFRESH
+        return Changed(assignment)
 
     def select(self, widget, id):
         # select the part pile to get parts from
@@ -231,7 +242,7 @@ class ItemSelector(GenericSelector):
         (_(u"serial no."), "weight", 1, "serial"),
         (_(u"kit"), "fixed", 3, "kit"),
         (_(u"changed"), "fixed", 10, "history.date"),
-        (_(u"added"), "fixed", 10, "history.beginning.date")
+        (_(u"added"), "fixed", 10, "history.root.started")
         ]
 
     def __init__(self, a, store, project):
@@ -279,6 +290,9 @@ class ProjectSelector(GenericSelector):
         (_(u"summary"), "weight", 3, "summary"),
         (_(u"cnt"), "fixed", 3, "count_items")
         ]
+    AGGREGATES = {
+        "count_items": (model.Item.project_id, Count(model.Item.id))
+        }
 
     def select(self, widget, id):
         return ItemSelector(self.app, self.store, project = widget._data)
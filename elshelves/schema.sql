@@ -6,7 +6,7 @@ CREATE TABLE meta (
        changed timestamp default CURRENT_TIMESTAMP
 );
 
-INSERT INTO meta (key, value) VALUES ("version", "0.1.1");
+INSERT INTO meta (key, value) VALUES ("version", "0.1.14");
 
 CREATE TABLE sources (
        id integer PRIMARY KEY autoincrement,
@@ -42,6 +42,10 @@ CREATE TABLE prices (
        currency varchar
 );
 
+CREATE VIEW prices_current AS
+       SELECT * FROM prices
+       WHERE time IS (SELECT max(time) FROM prices AS newest WHERE newest.id = prices.id);
+
 CREATE TABLE tags (
        id integer PRIMARY KEY autoincrement,
        name varchar unique not null check (length(name)),
@@ -62,11 +66,37 @@ CREATE TABLE history (
        time datetime not null default CURRENT_TIMESTAMP,
        event int,
        description varchar,
-       location_id integer references locations (id) on delete restrict on update cascade
+       location_id integer references locations (id) on delete restrict on update cascade,
+       root_id integer references history (id) on delete restrict on update cascade,
+       root_time datetime
 );
 
 CREATE INDEX history_parent on history (parent_id);
 
+CREATE INDEX history_root on history (root_id);
+
+CREATE TRIGGER history_insert AFTER INSERT ON history BEGIN
+UPDATE history SET root_id = coalesce((SELECT root_id FROM history WHERE id = new.parent_id), new.id)
+       WHERE id = new.id;
+END;
+
+CREATE TRIGGER history_reparent AFTER UPDATE OF parent_id ON history WHEN new.parent_id IS NOT old.parent_id AND NOT (new.parent_id IS NULL AND new.root_id IS new.id) BEGIN
+SELECT RAISE(ABORT, 'history can only be appended to') WHERE old.parent_id IS NOT NULL;
+SELECT RAISE(ABORT, 'history cycle') WHERE (SELECT root_id FROM history WHERE id = new.parent_id) = old.root_id;
+UPDATE history SET root_id = coalesce((SELECT root_id FROM history WHERE id = new.parent_id), new.id)
+       WHERE root_id = old.root_id;
+END;
+
+CREATE TABLE history_archive (
+       id integer PRIMARY KEY,
+       parent_id integer,
+       time datetime not null,
+       event int,
+       description varchar,
+       location_id integer,
+       archived datetime not null default CURRENT_TIMESTAMP
+);
+
 
 CREATE TABLE projects (
        id integer PRIMARY KEY autoincrement,
@@ -95,9 +125,22 @@ CREATE TABLE types (
        pins integer,
        footprint_id integer not null references footprints (id) on delete restrict on update cascade,
        datasheet varchar,
-       manufacturer varchar
+       manufacturer varchar,
+       changed timestamp
 );
 
+CREATE INDEX types_changed on types (changed);
+
+CREATE INDEX types_name on types (name);
+
+CREATE TRIGGER types_insert AFTER INSERT ON types BEGIN
+UPDATE types SET changed = CURRENT_TIMESTAMP WHERE id = new.id;
+END;
+
+CREATE TRIGGER types_update AFTER UPDATE ON types BEGIN
+UPDATE types SET changed = CURRENT_TIMESTAMP WHERE id = new.id;
+END;
+
 CREATE TABLE terms_types (
        term_id integer not null references terms (id) on delete cascade on update cascade,
        type_id integer not null references types (id) on delete cascade on update cascade
@@ -110,9 +153,66 @@ CREATE UNIQUE INDEX term_type_mapping on terms_types (term_id, type_id);
 CREATE TABLE terms (
        id integer not null PRIMARY KEY autoincrement,
        term varchar not null UNIQUE check (length(term)),
-       alias_for_id integer references terms (id) on delete restrict on update cascade
+       alias_for_id integer references terms (id) on delete restrict on update cascade,
+       canonical_id integer,
+       alias_path varchar
+);
+
+CREATE INDEX terms_canonical on terms (canonical_id);
+
+CREATE TRIGGER terms_insert AFTER INSERT ON terms BEGIN
+UPDATE terms SET canonical_id = coalesce((SELECT canonical_id FROM terms WHERE id = new.alias_for_id), new.id),
+                 alias_path = coalesce((SELECT alias_path FROM terms WHERE id = new.alias_for_id), '/') || new.id || '/'
+       WHERE id = new.id;
+END;
+
+CREATE TRIGGER terms_alias AFTER UPDATE OF alias_for_id ON terms WHEN new.alias_for_id IS NOT old.alias_for_id BEGIN
+SELECT RAISE(ABORT, 'alias cycle') WHERE substr((SELECT alias_path FROM terms WHERE id = new.alias_for_id), 1, length(old.alias_path)) = old.alias_path;
+INSERT INTO index_queue (type_id) SELECT type_id FROM terms_types WHERE term_id = old.canonical_id AND old.alias_for_id IS NOT NULL;
+UPDATE terms SET canonical_id = coalesce((SELECT canonical_id FROM terms WHERE id = new.alias_for_id), new.id),
+                 alias_path = coalesce((SELECT alias_path FROM terms WHERE id = new.alias_for_id), '/') || new.id || '/' || substr(alias_path, length(old.alias_path) + 1)
+       WHERE substr(alias_path, 1, length(old.alias_path)) = old.alias_path;
+UPDATE OR IGNORE terms_types SET term_id = (SELECT canonical_id FROM terms WHERE id = terms_types.term_id)
+       WHERE term_id IN (SELECT id FROM terms WHERE canonical_id != id);
+DELETE FROM terms_types WHERE term_id IN (SELECT id FROM terms WHERE canonical_id != id);
+END;
+
+CREATE TABLE terms_trigrams (
+       trigram varchar not null,
+       term_id integer not null references terms (id) on delete cascade on update cascade
 );
 
+CREATE UNIQUE INDEX term_trigram on terms_trigrams (trigram, term_id);
+
+CREATE INDEX term_trigram_term on terms_trigrams (term_id);
+
+CREATE TRIGGER terms_trigrams_insert AFTER INSERT ON terms BEGIN
+INSERT OR IGNORE INTO terms_trigrams (trigram, term_id)
+WITH RECURSIVE pos(i) AS (
+     SELECT 1
+     UNION ALL
+     SELECT i + 1 FROM pos WHERE i < length(new.term)
+) SELECT substr(new.term, i, 3), new.id FROM pos;
+END;
+
+CREATE TABLE index_queue (
+       id integer PRIMARY KEY autoincrement,
+       type_id integer not null,
+       queued timestamp not null default CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER index_queue_insert AFTER INSERT ON types BEGIN
+INSERT INTO index_queue (type_id) VALUES (new.id);
+END;
+
+CREATE TRIGGER index_queue_update AFTER UPDATE OF name, summary, description, manufacturer ON types BEGIN
+INSERT INTO index_queue (type_id) VALUES (new.id);
+END;
+
+CREATE TRIGGER index_queue_delete AFTER DELETE ON types BEGIN
+INSERT INTO index_queue (type_id) VALUES (old.id);
+END;
+
 CREATE TABLE assignments (
        id integer PRIMARY KEY autoincrement,
        part_type_id integer not null references types (id) on delete cascade on update cascade,
@@ -136,6 +236,10 @@ CREATE TABLE parts (
 
 CREATE INDEX parts_buys on parts (date, source_id);
 
+CREATE INDEX parts_type on parts (part_type_id);
+
+CREATE INDEX parts_assignment on parts (assignment_id) WHERE assignment_id IS NOT NULL;
+
 CREATE TRIGGER parts_update AFTER UPDATE OF assignment_id ON parts WHEN new.assignment_id != NULL BEGIN
 INSERT INTO history (parent_id,event,description) VALUES (new.history_id, 3, "_added to project");
 UPDATE parts SET history_id = rowid WHERE id = new.id;
@@ -166,6 +270,44 @@ INSERT INTO history (parent_id,event,description) VALUES (new.history_id, 3, "_r
 UPDATE parts SET history_id = rowid WHERE id = new.id;
 END;
 
+CREATE TABLE stock_counters (
+       type_id integer PRIMARY KEY references types (id) on delete cascade on update cascade,
+       free integer not null default 0,
+       assigned integer not null default 0,
+       soldered integer not null default 0,
+       unusable integer not null default 0
+);
+
+CREATE TRIGGER stock_insert AFTER INSERT ON parts BEGIN
+INSERT OR IGNORE INTO stock_counters (type_id) VALUES (new.part_type_id);
+UPDATE stock_counters SET free = free + (new.usable AND NOT new.soldered AND new.assignment_id IS NULL) * new.count,
+                          assigned = assigned + (new.usable AND NOT new.soldered AND new.assignment_id IS NOT NULL) * new.count,
+                          soldered = soldered + (new.usable AND new.soldered) * new.count,
+                          unusable = unusable + (NOT new.usable) * new.count
+       WHERE type_id = new.part_type_id;
+END;
+
+CREATE TRIGGER stock_update AFTER UPDATE OF count, part_type_id, assignment_id, soldered, usable ON parts BEGIN
+UPDATE stock_counters SET free = free - (old.usable AND NOT old.soldered AND old.assignment_id IS NULL) * old.count,
+                          assigned = assigned - (old.usable AND NOT old.soldered AND old.assignment_id IS NOT NULL) * old.count,
+                          soldered = soldered - (old.usable AND old.soldered) * old.count,
+                          unusable = unusable - (NOT old.usable) * old.count
+       WHERE type_id = old.part_type_id;
+INSERT OR IGNORE INTO stock_counters (type_id) VALUES (new.part_type_id);
+UPDATE stock_counters SET free = free + (new.usable AND NOT new.soldered AND new.assignment_id IS NULL) * new.count,
+                          assigned = assigned + (new.usable AND NOT new.soldered AND new.assignment_id IS NOT NULL) * new.count,
+                          soldered = soldered + (new.usable AND new.soldered) * new.count,
+                          unusable = unusable + (NOT new.usable) * new.count
+       WHERE type_id = new.part_type_id;
+END;
+
+CREATE TRIGGER stock_delete AFTER DELETE ON parts BEGIN
+UPDATE stock_counters SET free = free - (old.usable AND NOT old.soldered AND old.assignment_id IS NULL) * old.count,
+                          assigned = assigned - (old.usable AND NOT old.soldered AND old.assignment_id IS NOT NULL) * old.count,
+                          soldered = soldered - (old.usable AND old.soldered) * old.count,
+                          unusable = unusable - (NOT old.usable) * old.count
+       WHERE type_id = old.part_type_id;
+END;
 
 CREATE TABLE types_sources (
        part_type_id integer not null references types (id) on delete cascade on update cascade,
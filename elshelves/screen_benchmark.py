@@ -0,0 +1,145 @@
+# encoding: utf8
+
+"""Benchmark of building and drawing the screens.
+
+Creates temporary databases using the generator of synthetic data
+and measures show() and rendering of the screens using a screen
+which needs no terminal, every screen in its own process:
+
+    python -m elshelves.screen_benchmark [--sizes N,...] [--screens NAME,...]
+"""
+
+import gettext
+gettext.install('elshelves', unicode=1)
+
+import os
+import sys
+import time
+import random
+import shutil
+import resource
+import optparse
+import tempfile
+import traceback
+
+import urwid.raw_display
+import storm.tracer
+import model
+import app
+import generate
+from benchmark import QueryCounter
+from generate import WORDS
+from browser import Browser, RawPartBrowser, PartBrowser
+from project_selector import ProjectSelector, AssignmentSelector
+from part_selector import PartSelector, PartCreator
+from main import SearchBrowser
+
+class HeadlessScreen(urwid.raw_display.Screen):
+    """Screen of fixed size, it is never started so no terminal is needed"""
+
+    def __init__(self, size):
+        urwid.raw_display.Screen.__init__(self)
+        self._size = size
+
+    def get_cols_rows(self):
+        return self._size
+
+def order(lines, rnd):
+    """Returns the RawParts of an order with lines searched by a word"""
+    return [model.RawPart({"search_name": rnd.choice(WORDS), "count": 1})
+            for i in range(lines)]
+
+def screens(item_id, rnd):
+    """Returns list of (name, function creating the screen for app and store)"""
+    return [
+        ("Browser", lambda a, store: Browser(a, store)),
+        ("RawPartBrowser", lambda a, store: RawPartBrowser(a, store)),
+        ("PartBrowser", lambda a, store: PartBrowser(a, store)),
+        ("ProjectSelector", lambda a, store: ProjectSelector(a, store)),
+        ("AssignmentSelector", lambda a, store: AssignmentSelector(a, store, store.get(model.Item, item_id))),
+        ("PartSelector", lambda a, store: PartSelector(a, store, order(20, rnd), PartCreator)),
+        ("SearchBrowser", lambda a, store: SearchBrowser(a, store, rnd.choice(WORDS)))
+        ]
+
+def forked(function, *args):
+    """Runs function(*args) in a forked process and waits for it, so its
+       peak memory is its own and nothing it allocates stays in this
+       process. Returns True when the function succeeded."""
+    pid = os.fork()
+    if pid:
+        pid, status = os.waitpid(pid, 0)
+        return status == 0
+
+    status = 1
+    try:
+        function(*args)
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        os._exit(status)
+
+def populate(url, size, seed):
+    """Creates the database of the given size"""
+    store = model.getStore(url, create = True)
+    generate.generate(store, random.Random(seed), footprints = max(1, size // 10),
+                      types = size, piles = size, projects = 5,
+                      assignments = max(1, min(size // 10, 200)))
+    store.close()
+
+def measure(name, size, screen_size, url, create):
+    """Shows and draws the screen created by create using a new database
+       connection, prints the wall time, number of queries, peak memory
+       of the process and its growth while the screen was built"""
+    store = model.getStore(url)
+    a = app.App(u"benchmark")
+    a.screen = HeadlessScreen(screen_size)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    counter = QueryCounter()
+    storm.tracer.install_tracer(counter)
+    start = time.time()
+    try:
+        a.switch_screen_with_return(create(a, store))
+        a.frame.render(screen_size, focus = True)
+    finally:
+        storm.tracer.remove_tracer(counter)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%-20s %8d %8.3f s %8d queries %8.1f MB %+8.1f MB" % (name, size, time.time() - start,
+                                                             counter.count, peak / 1024.0,
+                                                             (peak - before) / 1024.0)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--sizes", default = "1000",
+                      help = "comma separated numbers of part types and piles in the databases")
+    parser.add_option("--screens", default = None,
+                      help = "comma separated names of the measured screens, all by default")
+    parser.add_option("--width", type="int", default = 120)
+    parser.add_option("--height", type="int", default = 40)
+    parser.add_option("--seed", type="int", default = 0)
+    opts, args = parser.parse_args()
+
+    selected = opts.screens and opts.screens.split(",")
+    for size in [int(s) for s in opts.sizes.split(",")]:
+        tmpdir = tempfile.mkdtemp(prefix = "elshelves-benchmark")
+        try:
+            url = "sqlitefk:%s" % os.path.join(tmpdir, "benchmark.sqlite3")
+            if not forked(populate, url, size, opts.seed):
+                continue
+
+            # every item has assignments, take the first one
+            rnd = random.Random(opts.seed)
+            for name, create in screens(1, rnd):
+                if selected and name not in selected:
+                    continue
+
+                # a new process for every screen starts with empty caches
+                forked(measure, name, size, (opts.width, opts.height), url, create)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+CREATE TABLE terms_trigrams (
+       trigram varchar not null,
+       term_id integer not null references terms (id) on delete cascade on update cascade
+);
+
+CREATE UNIQUE INDEX term_trigram on terms_trigrams (trigram, term_id);
+
+CREATE INDEX term_trigram_term on terms_trigrams (term_id);
+
+INSERT OR IGNORE INTO terms_trigrams (trigram, term_id)
+WITH RECURSIVE pos(term_id, term, i) AS (
+     SELECT id, term, 1 FROM terms
+     UNION ALL
+     SELECT term_id, term, i + 1 FROM pos WHERE i < length(term)
+) SELECT substr(term, i, 3), term_id FROM pos;
+
+UPDATE meta SET value = "0.1.2", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,5 @@
+-- types_fts_delete existed only in databases created by an intermediate
+-- development version, this only cleans them up and bumps the version
+DROP TRIGGER IF EXISTS types_fts_delete;
+
+UPDATE meta SET value = "0.1.11", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,22 @@
+ALTER TABLE history ADD COLUMN root_time datetime;
+
+CREATE TEMPORARY TABLE history_origins (
+       id integer PRIMARY KEY,
+       time datetime
+);
+
+INSERT INTO history_origins (id, time)
+WITH RECURSIVE chain(id, ancestor, time) AS (
+     SELECT history.id, history_archive.parent_id, history_archive.time
+     FROM history JOIN history_archive ON history_archive.id = history.id
+     UNION ALL
+     SELECT chain.id, history_archive.parent_id, history_archive.time
+     FROM chain JOIN history_archive ON history_archive.id = chain.ancestor
+) SELECT id, time FROM chain WHERE ancestor IS NULL;
+
+UPDATE history SET root_time = (SELECT time FROM history_origins WHERE history_origins.id = history.id)
+       WHERE id IN (SELECT id FROM history_origins);
+
+DROP TABLE history_origins;
+
+UPDATE meta SET value = "0.1.12", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,10 @@
+CREATE TRIGGER terms_trigrams_insert AFTER INSERT ON terms BEGIN
+INSERT OR IGNORE INTO terms_trigrams (trigram, term_id)
+WITH RECURSIVE pos(i) AS (
+     SELECT 1
+     UNION ALL
+     SELECT i + 1 FROM pos WHERE i < length(new.term)
+) SELECT substr(new.term, i, 3), new.id FROM pos;
+END;
+
+UPDATE meta SET value = "0.1.13", changed = CURRENT_TIMESTAMP WHERE key = "version";
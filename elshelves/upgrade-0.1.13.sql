@@ -0,0 +1,10 @@
+DROP TRIGGER history_reparent;
+
+CREATE TRIGGER history_reparent AFTER UPDATE OF parent_id ON history WHEN new.parent_id IS NOT old.parent_id AND NOT (new.parent_id IS NULL AND new.root_id IS new.id) BEGIN
+SELECT RAISE(ABORT, 'history can only be appended to') WHERE old.parent_id IS NOT NULL;
+SELECT RAISE(ABORT, 'history cycle') WHERE (SELECT root_id FROM history WHERE id = new.parent_id) = old.root_id;
+UPDATE history SET root_id = coalesce((SELECT root_id FROM history WHERE id = new.parent_id), new.id)
+       WHERE root_id = old.root_id;
+END;
+
+UPDATE meta SET value = "0.1.14", changed = CURRENT_TIMESTAMP WHERE key = "version";
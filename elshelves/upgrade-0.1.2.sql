@@ -0,0 +1,15 @@
+ALTER TABLE types ADD COLUMN changed timestamp;
+
+UPDATE types SET changed = CURRENT_TIMESTAMP;
+
+CREATE INDEX types_changed on types (changed);
+
+CREATE TRIGGER types_insert AFTER INSERT ON types BEGIN
+UPDATE types SET changed = CURRENT_TIMESTAMP WHERE id = new.id;
+END;
+
+CREATE TRIGGER types_update AFTER UPDATE ON types BEGIN
+UPDATE types SET changed = CURRENT_TIMESTAMP WHERE id = new.id;
+END;
+
+UPDATE meta SET value = "0.1.3", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,19 @@
+CREATE TABLE index_queue (
+       id integer PRIMARY KEY autoincrement,
+       type_id integer not null,
+       queued timestamp not null default CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER index_queue_insert AFTER INSERT ON types BEGIN
+INSERT INTO index_queue (type_id) VALUES (new.id);
+END;
+
+CREATE TRIGGER index_queue_update AFTER UPDATE OF name, summary, description, manufacturer ON types BEGIN
+INSERT INTO index_queue (type_id) VALUES (new.id);
+END;
+
+CREATE TRIGGER index_queue_delete AFTER DELETE ON types BEGIN
+INSERT INTO index_queue (type_id) VALUES (old.id);
+END;
+
+UPDATE meta SET value = "0.1.4", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,38 @@
+ALTER TABLE terms ADD COLUMN canonical_id integer;
+
+ALTER TABLE terms ADD COLUMN alias_path varchar;
+
+WITH RECURSIVE chain(id, canonical, path) AS (
+     SELECT id, id, '/' || id || '/' FROM terms WHERE alias_for_id IS NULL
+     UNION ALL
+     SELECT terms.id, chain.canonical, chain.path || terms.id || '/' FROM terms JOIN chain ON terms.alias_for_id = chain.id
+) UPDATE terms SET canonical_id = (SELECT canonical FROM chain WHERE chain.id = terms.id),
+                   alias_path = (SELECT path FROM chain WHERE chain.id = terms.id);
+
+UPDATE terms SET canonical_id = id, alias_path = '/' || id || '/', alias_for_id = NULL WHERE canonical_id IS NULL;
+
+UPDATE OR IGNORE terms_types SET term_id = (SELECT canonical_id FROM terms WHERE id = terms_types.term_id)
+       WHERE term_id IN (SELECT id FROM terms WHERE canonical_id != id);
+
+DELETE FROM terms_types WHERE term_id IN (SELECT id FROM terms WHERE canonical_id != id);
+
+CREATE INDEX terms_canonical on terms (canonical_id);
+
+CREATE TRIGGER terms_insert AFTER INSERT ON terms BEGIN
+UPDATE terms SET canonical_id = coalesce((SELECT canonical_id FROM terms WHERE id = new.alias_for_id), new.id),
+                 alias_path = coalesce((SELECT alias_path FROM terms WHERE id = new.alias_for_id), '/') || new.id || '/'
+       WHERE id = new.id;
+END;
+
+CREATE TRIGGER terms_alias AFTER UPDATE OF alias_for_id ON terms WHEN new.alias_for_id IS NOT old.alias_for_id BEGIN
+SELECT RAISE(ABORT, 'alias cycle') WHERE substr((SELECT alias_path FROM terms WHERE id = new.alias_for_id), 1, length(old.alias_path)) = old.alias_path;
+INSERT INTO index_queue (type_id) SELECT type_id FROM terms_types WHERE term_id = old.canonical_id AND old.alias_for_id IS NOT NULL;
+UPDATE terms SET canonical_id = coalesce((SELECT canonical_id FROM terms WHERE id = new.alias_for_id), new.id),
+                 alias_path = coalesce((SELECT alias_path FROM terms WHERE id = new.alias_for_id), '/') || new.id || '/' || substr(alias_path, length(old.alias_path) + 1)
+       WHERE substr(alias_path, 1, length(old.alias_path)) = old.alias_path;
+UPDATE OR IGNORE terms_types SET term_id = (SELECT canonical_id FROM terms WHERE id = terms_types.term_id)
+       WHERE term_id IN (SELECT id FROM terms WHERE canonical_id != id);
+DELETE FROM terms_types WHERE term_id IN (SELECT id FROM terms WHERE canonical_id != id);
+END;
+
+UPDATE meta SET value = "0.1.5", changed = CURRENT_TIMESTAMP WHERE key = "version";
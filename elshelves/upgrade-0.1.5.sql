@@ -0,0 +1,48 @@
+CREATE TABLE stock_counters (
+       type_id integer PRIMARY KEY references types (id) on delete cascade on update cascade,
+       free integer not null default 0,
+       assigned integer not null default 0,
+       soldered integer not null default 0,
+       unusable integer not null default 0
+);
+
+CREATE TRIGGER stock_insert AFTER INSERT ON parts BEGIN
+INSERT OR IGNORE INTO stock_counters (type_id) VALUES (new.part_type_id);
+UPDATE stock_counters SET free = free + (new.usable AND NOT new.soldered AND new.assignment_id IS NULL) * new.count,
+                          assigned = assigned + (new.usable AND NOT new.soldered AND new.assignment_id IS NOT NULL) * new.count,
+                          soldered = soldered + (new.usable AND new.soldered) * new.count,
+                          unusable = unusable + (NOT new.usable) * new.count
+       WHERE type_id = new.part_type_id;
+END;
+
+CREATE TRIGGER stock_update AFTER UPDATE OF count, part_type_id, assignment_id, soldered, usable ON parts BEGIN
+UPDATE stock_counters SET free = free - (old.usable AND NOT old.soldered AND old.assignment_id IS NULL) * old.count,
+                          assigned = assigned - (old.usable AND NOT old.soldered AND old.assignment_id IS NOT NULL) * old.count,
+                          soldered = soldered - (old.usable AND old.soldered) * old.count,
+                          unusable = unusable - (NOT old.usable) * old.count
+       WHERE type_id = old.part_type_id;
+INSERT OR IGNORE INTO stock_counters (type_id) VALUES (new.part_type_id);
+UPDATE stock_counters SET free = free + (new.usable AND NOT new.soldered AND new.assignment_id IS NULL) * new.count,
+                          assigned = assigned + (new.usable AND NOT new.soldered AND new.assignment_id IS NOT NULL) * new.count,
+                          soldered = soldered + (new.usable AND new.soldered) * new.count,
+                          unusable = unusable + (NOT new.usable) * new.count
+       WHERE type_id = new.part_type_id;
+END;
+
+CREATE TRIGGER stock_delete AFTER DELETE ON parts BEGIN
+UPDATE stock_counters SET free = free - (old.usable AND NOT old.soldered AND old.assignment_id IS NULL) * old.count,
+                          assigned = assigned - (old.usable AND NOT old.soldered AND old.assignment_id IS NOT NULL) * old.count,
+                          soldered = soldered - (old.usable AND old.soldered) * old.count,
+                          unusable = unusable - (NOT old.usable) * old.count
+       WHERE type_id = old.part_type_id;
+END;
+
+INSERT INTO stock_counters (type_id, free, assigned, soldered, unusable)
+       SELECT part_type_id,
+              sum((usable AND NOT soldered AND assignment_id IS NULL) * count),
+              sum((usable AND NOT soldered AND assignment_id IS NOT NULL) * count),
+              sum((usable AND soldered) * count),
+              sum((NOT usable) * count)
+       FROM parts GROUP BY part_type_id;
+
+UPDATE meta SET value = "0.1.6", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,33 @@
+ALTER TABLE history ADD COLUMN root_id integer references history (id) on delete restrict on update cascade;
+
+CREATE TEMPORARY TABLE history_roots (
+       id integer PRIMARY KEY,
+       root_id integer
+);
+
+INSERT INTO history_roots (id, root_id)
+WITH RECURSIVE chain(id, root_id) AS (
+     SELECT id, id FROM history WHERE parent_id IS NULL
+     UNION ALL
+     SELECT history.id, chain.root_id FROM history JOIN chain ON history.parent_id = chain.id
+) SELECT id, root_id FROM chain;
+
+UPDATE history SET root_id = (SELECT root_id FROM history_roots WHERE history_roots.id = history.id);
+
+DROP TABLE history_roots;
+
+CREATE INDEX history_root on history (root_id);
+
+CREATE TRIGGER history_insert AFTER INSERT ON history BEGIN
+UPDATE history SET root_id = coalesce((SELECT root_id FROM history WHERE id = new.parent_id), new.id)
+       WHERE id = new.id;
+END;
+
+CREATE TRIGGER history_reparent AFTER UPDATE OF parent_id ON history WHEN new.parent_id IS NOT old.parent_id BEGIN
+SELECT RAISE(ABORT, 'history can only be appended to') WHERE old.parent_id IS NOT NULL;
+SELECT RAISE(ABORT, 'history cycle') WHERE (SELECT root_id FROM history WHERE id = new.parent_id) = old.root_id;
+UPDATE history SET root_id = coalesce((SELECT root_id FROM history WHERE id = new.parent_id), new.id)
+       WHERE root_id = old.root_id;
+END;
+
+UPDATE meta SET value = "0.1.7", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,20 @@
+CREATE TABLE history_archive (
+       id integer PRIMARY KEY,
+       parent_id integer,
+       time datetime not null,
+       event int,
+       description varchar,
+       location_id integer,
+       archived datetime not null default CURRENT_TIMESTAMP
+);
+
+DROP TRIGGER history_reparent;
+
+CREATE TRIGGER history_reparent AFTER UPDATE OF parent_id ON history WHEN new.parent_id IS NOT old.parent_id AND new.root_id IS old.root_id BEGIN
+SELECT RAISE(ABORT, 'history can only be appended to') WHERE old.parent_id IS NOT NULL;
+SELECT RAISE(ABORT, 'history cycle') WHERE (SELECT root_id FROM history WHERE id = new.parent_id) = old.root_id;
+UPDATE history SET root_id = coalesce((SELECT root_id FROM history WHERE id = new.parent_id), new.id)
+       WHERE root_id = old.root_id;
+END;
+
+UPDATE meta SET value = "0.1.8", changed = CURRENT_TIMESTAMP WHERE key = "version";
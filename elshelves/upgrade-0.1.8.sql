@@ -0,0 +1,5 @@
+CREATE VIEW prices_current AS
+       SELECT * FROM prices
+       WHERE time IS (SELECT max(time) FROM prices AS newest WHERE newest.id = prices.id);
+
+UPDATE meta SET value = "0.1.9", changed = CURRENT_TIMESTAMP WHERE key = "version";
@@ -0,0 +1,7 @@
+CREATE INDEX types_name on types (name);
+
+CREATE INDEX parts_type on parts (part_type_id);
+
+CREATE INDEX parts_assignment on parts (assignment_id) WHERE assignment_id IS NOT NULL;
+
+UPDATE meta SET value = "0.1.10", changed = CURRENT_TIMESTAMP WHERE key = "version";